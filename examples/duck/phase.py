@@ -3,6 +3,8 @@ import ConfigParser
 import time
 import re
 import copy
+import multiprocessing
+import multiprocessing.sharedctypes
 
 import phasing_3d
 
@@ -17,28 +19,338 @@ from crappy_crystals import utils
 from crappy_crystals.phasing.maps import Mapper_naive, Mapper_ellipse
 
 
+# the stopping criteria of a stage and their types
+stop_keys = {'tol' : float, 'window' : int, 'time' : float}
+
 def config_iters_to_alg_num(string):
-    # split a string like '100ERA 200DM 50ERA' with the numbers
-    steps = re.split('(\d+)', string)   # ['', '100', 'ERA ', '200', 'DM ', '50', 'ERA']
+    """
+    Parse an iteration schedule like '200DM 100ERA[tol=1e-3, window=20] 50ERA[time=60]'
+    into [[alg, iters, stop], ...]:
+        [['DM', 200, {}], ['ERA', 100, {'tol' : 0.001, 'window' : 20}], ['ERA', 50, {'time' : 60.0}]]
+    
+    iters is the maximum number of iterations of the stage, it stops early if:
+        tol  : the relative improvement in eMod over the last 'window' 
+               iterations (default 10) is less than tol
+        time : the stage has run for this many seconds (wall clock)
+    
+    The criteria of ERA stages are checked every 'window' iterations 
+    (see stop_reason), by running the stage in chunks of 'window' iterations.
     
-    # get rid of empty strings
-    steps = [s for s in steps if len(s)>0] # ['100', 'ERA ', '200', 'DM ', '50', 'ERA']
+    phasing_3d.DM cannot be continued from the object that it returns, so
+    the other stages are not chunked. 'time' bounds the number of iterations
+    of the call instead (see iters_in_time): at the rate of the earlier stages
+    of the repeat, or of its first 'window' iterations (run as a separate 
+    call) if it is the first stage. 'tol' cannot be checked, it is ignored
+    and recorded as such in the stop record of the stage (see stops_dtype).
+    """
+    pattern   = '(\d+)\s*([A-Za-z]+)\s*(?:\[([^\]]*)\])?'
+    if re.sub(pattern, '', string).strip() != '' :
+        raise ValueError('could not parse the iteration schedule: ' + string)
     
-    # pair alg and iters
-    # [['ERA', 100], ['DM', 200], ['ERA', 50]]
-    alg_iters = [ [steps[i+1].strip(), int(steps[i])] for i in range(0, len(steps), 2)]
+    alg_iters = []
+    for iters, alg, criteria in re.findall(pattern, string):
+        stop = {}
+        for c in criteria.split(','):
+            if c.strip() == '' :
+                continue
+            key, value = [x.strip() for x in c.split('=')]
+            if key not in stop_keys :
+                raise ValueError('unknown stopping criterion ' + key + ' in: ' + string)
+            stop[key] = stop_keys[key](value)
+        
+        if len(stop) > 0 :
+            stop.setdefault('window', 10)
+        alg_iters.append([alg, int(iters), stop])
     return alg_iters
 
-def phase(I, support, params, good_pix = None, sample_known = None):
+def stop_reason(stop, eMod, t):
+    """
+    Return 'time' or 'tol' if the stage should stop (see config_iters_to_alg_num)
+    given the eMod of each iteration of the stage so far and its run time t, or None.
+    """
+    if 'time' in stop and t >= stop['time'] :
+        return 'time'
+    
+    w = stop.get('window', 10)
+    if 'tol' in stop and len(eMod) > w :
+        e0, e1 = eMod[-w-1], eMod[-1]
+        if e0 > 0 and (e0 - e1) / e0 < stop['tol'] :
+            return 'tol'
+    return None
+
+def checked_criteria(alg, stop):
+    """the stopping criteria in stop that are checked for alg stages (see config_iters_to_alg_num)"""
+    if alg == 'ERA' :
+        return stop
+    return dict([(k, v) for k, v in stop.items() if k != 'tol'])
+
+def iters_in_time(stop, t, i, stops):
+    """
+    The number of iterations of a stage that fit in the rest of its 'time'
+    (t seconds have passed after i iterations), at the rate of the stage so 
+    far or else of the earlier stages (stops, see stops_dtype). None if 
+    there is no rate yet.
+    """
+    if i > 0 :
+        its, ts = i, t
+    else :
+        its, ts = sum([s[1] for s in stops]), sum([s[4] for s in stops])
+    
+    if its == 0 or ts <= 0 :
+        return None
+    return max(1, int((stop['time'] - t) * its / ts))
+
+# why and when each stage stopped: 
+#   (alg, iterations run, max iterations, reason, time (s), criteria that were ignored)
+stops_dtype = [('alg', 'S16'), ('iters', np.int64), ('max_iters', np.int64), ('reason', 'S8'), 
+               ('time', np.float64), ('ignored', 'S16')]
+
+def share(a):
+    """
+    Copy the numpy array a into shared memory so that worker processes 
+    can read it without it being pickled or copied, see unshare.
+    Anything else is returned as is.
+    """
+    if not isinstance(a, np.ndarray):
+        return a
+    raw = multiprocessing.sharedctypes.RawArray('b', max(a.nbytes, 1))
+    b   = np.frombuffer(raw, dtype=a.dtype, count=a.size).reshape(a.shape)
+    b[...] = a
+    return (raw, a.shape, a.dtype.str)
+
+def unshare(s):
+    """
+    The numpy view of an array that was put in shared memory with share.
+    """
+    if not isinstance(s, tuple):
+        return s
+    raw, shape, dtype = s
+    return np.frombuffer(raw, dtype=np.dtype(dtype), count=int(np.prod(shape))).reshape(shape)
+
+# the phasing parameters and the shared (read only) arrays of each worker
+_shared = {}
+
+def _init_worker(params, shared):
+    _shared.clear()
+    _shared['params'] = params
+    _shared.update(shared)
+
+def write_checkpoint(fnam, state):
+    """
+    Write the state of a repeat (a dictionary of arrays, scalars or None,
+    and the numpy random state 'rng') to the h5 file fnam. The file is 
+    written to fnam.tmp then renamed so that an interrupted write 
+    does not destroy the last checkpoint.
+    """
+    import h5py
+    f = h5py.File(fnam + '.tmp', 'w')
+    for key, value in state.items():
+        if value is None :
+            continue
+        if key == 'rng' :
+            name, keys, pos, has_gauss, cached_gaussian = value
+            f.create_dataset('rng_keys', data = keys)
+            f['rng_keys'].attrs['name']            = name
+            f['rng_keys'].attrs['pos']             = pos
+            f['rng_keys'].attrs['has_gauss']       = has_gauss
+            f['rng_keys'].attrs['cached_gaussian'] = cached_gaussian
+        else :
+            f.create_dataset(key, data = value)
+    f.close()
+    os.rename(fnam + '.tmp', fnam)
+
+def read_checkpoint(fnam):
+    """
+    Read the state written by write_checkpoint, missing entries are None.
+    """
+    import h5py
+    f = h5py.File(fnam, 'r')
+    state = {}
+    for key in ['step', 'iter', 'stage_time', 'stops', 'O', 'support', 'background', 'B_rav', 'I', 'eMod', 'eCon']:
+        if key in f :
+            state[key] = f[key][()]
+        else :
+            state[key] = None
+    
+    a = f['rng_keys'].attrs
+    state['rng'] = (str(a['name']), f['rng_keys'][()], int(a['pos']), int(a['has_gauss']), float(a['cached_gaussian']))
+    f.close()
+    return state
+
+def phase_repeat(j, seed):
+    """
+    Run the phasing algorithms (in params['phasing']['iters']) from 
+    one random start, with the parameters and arrays set in _init_worker.
+
+    If params['phasing']['checkpoint_iters'] or ['checkpoint_time'] is set then 
+    the ERA stages are run in chunks of checkpoint_iters (or 10) iterations and 
+    the state is written to checkpoint_<j>.h5 in the output path after every 
+    chunk and stage (or when checkpoint_time seconds have passed since the last 
+    one). If _shared['resume'] is True the schedule is continued from there.
+    
+    The other stages are run in one call (unless they have a 'time' 
+    criterion, see config_iters_to_alg_num): phasing_3d.DM only returns the 
+    object and not its iterate, so restarting it from a checkpoint would 
+    change the algorithm. An interrupted DM stage is repeated from its start.
+    
+    A stage stops early if its stopping criteria are met (see 
+    config_iters_to_alg_num), d['stops'] records how each stage ended 
+    (see stops_dtype).
+    """
     d   = {'eMod' : [],         \
            'eCon' : [],         \
            'O'    : None,       \
+           'I'    : None,       \
            'background' : None, \
            'B_rav' : None, \
-           'support' : None     \
+           'support' : None,    \
+           'stops'   : [],      \
+           'profile' : None     \
             }
-    out = []
+    
+    # an independent random number stream for each repeat
+    np.random.seed(seed)
+    
+    # only the small parameters are copied, the arrays are shared
+    params   = copy.deepcopy(_shared['params'])
+    I        = unshare(_shared['I'])
+    good_pix = unshare(_shared['mask'])
+    params['phasing_parameters']['mask']    = good_pix
+    params['phasing_parameters']['support'] = unshare(_shared['support'])
+    
+    alg_iters = config_iters_to_alg_num(params['phasing']['iters'])
+    
+    # timing and memory of each stage (see utils.profiling)
+    #---------------------------------------------
+    prof  = None
+    timer = utils.profiling.no_timer
+    if params['phasing'].get('profile', False) :
+        prof  = utils.profiling.Profile()
+        timer = prof.timer
+        params['phasing_parameters']['Mapper'] = \
+                utils.profiling.profiled(params['phasing_parameters']['Mapper'], prof)
+    
+    # checkpoints
+    #---------------------------------------------
+    check_iters = params['phasing'].get('checkpoint_iters', None)
+    check_time  = params['phasing'].get('checkpoint_time', None)
+    checkpoint  = (check_iters is not None or check_time is not None) and 'output' in params
+    
+    step0, iter0, stage_time = 0, 0, 0.
+    if checkpoint :
+        fnam  = os.path.join(params['output']['path'], 'checkpoint_' + str(j) + '.h5')
+        chunk = check_iters or 10
+        
+        if _shared.get('resume', False) and os.path.exists(fnam):
+            print 'resuming repeat', j, 'from:', fnam
+            state = read_checkpoint(fnam)
+            step0, iter0 = int(state['step']), int(state['iter'])
+            if state['stage_time'] is not None :
+                stage_time = float(state['stage_time'])
+            if state['stops'] is not None :
+                # older checkpoints do not have every field
+                d['stops'] = [tuple(x) + ('',) * (len(stops_dtype) - len(x)) for x in state['stops']]
+            np.random.set_state(state['rng'])
+            for k in ['O', 'I', 'support', 'background', 'B_rav']:
+                d[k] = state[k]
+            d['eMod'] = list(state['eMod'])
+            d['eCon'] = list(state['eCon'])
+            
+            params['phasing_parameters']['O'] = d['O']
+            if d['support'] is not None :
+                params['phasing_parameters']['support'] = d['support']
+            if d['background'] is not None :
+                params['phasing_parameters']['background'] = d['background']
+    
+    t_check = time.time()
+    
+    # for testing
+    # params['phasing_parameters']['O'] = np.roll(sample_known, -4, 1) #* np.random.random(sample_known.shape)
+    for step, (alg, iters, stop) in enumerate(alg_iters) :
+        if step < step0 :
+            continue
+        
+        i  = iter0 if step == step0 else 0
+        t0 = time.time() - (stage_time if step == step0 else 0.)
+        # the eMod values of this stage start at e0
+        e0 = len(d['eMod']) - i
+        
+        checked = checked_criteria(alg, stop)
+        ignored = ','.join(sorted(set(stop) - set(checked)))
+        if ignored != '' :
+            print 'warning: the stopping criteria', ignored, 'are ignored for', alg, 'stages'
+        
+        while i < iters :
+            n = iters - i
+            if checkpoint and alg == 'ERA' :
+                n = min(chunk, n)
+            if len(stop) > 0 and alg == 'ERA' :
+                n = min(stop['window'], n)
+            
+            # bound the other stages by their time
+            bounded = False
+            if 'time' in checked and alg != 'ERA' :
+                m       = iters_in_time(stop, time.time() - t0, i, d['stops'])
+                bounded = m is not None
+                n       = min(stop['window'] if m is None else m, n)
+            
+            O = params['phasing_parameters']['O']
+            
+            with timer(alg, sample = False):
+                if alg == 'ERA':
+                   O, info = phasing_3d.ERA(I, n, **params['phasing_parameters'])
+                 
+                if alg == 'DM':
+                   O, info = phasing_3d.DM(I,  n, **params['phasing_parameters'])
+                 
+                if alg == 'cheshireScan':
+                   mapper  = params['phasing_parameters']['Mapper'](I, **params['phasing_parameters'])
+                   O, info = mapper.scans_cheshire(O)
+            
+            i += n
+            
+            d['O']           = params['phasing_parameters']['O']          = O
+            d['support']     = params['phasing_parameters']['support']    = info['support']
+            d['I']           = info['I']
+            d['eMod']       += info['eMod']
+            d['eCon']       += info['eCon']
+            
+            if 'background' in info.keys():
+                d['background']  = params['phasing_parameters']['background'] = info['background'] * good_pix
+                d['B_rav']       = info['r_av']
+            
+            t      = time.time() - t0
+            reason = stop_reason(checked, d['eMod'][e0:], t)
+            if reason is None and bounded and i < iters :
+                reason = 'time'
+            done   = reason is not None or i >= iters
+            if done :
+                d['stops'].append((alg, i, iters, reason or 'iters', t, ignored))
+                print alg, 'stopped after', i, 'of', iters, 'iterations (' + (reason or 'iters') + ') in %.1f s' % t
+            
+            if checkpoint and (check_iters is not None or done or time.time() - t_check >= check_time) :
+                # a stage that stopped early is complete
+                state = {'step' : step, 'iter' : i if reason is None else iters, 'stage_time' : t, 
+                         'stops' : np.array(d['stops'], dtype = stops_dtype),
+                         'rng' : np.random.get_state(), 
+                         'eMod' : np.array(d['eMod']), 'eCon' : np.array(d['eCon'])}
+                for k in ['O', 'I', 'support', 'background', 'B_rav']:
+                    state[k] = d[k]
+                write_checkpoint(fnam, state)
+                t_check = time.time()
+            
+            if reason is not None :
+                break
+
+    d['eMod'] = np.array(d['eMod'])
+    d['eCon'] = np.array(d['eCon'])
+    
+    if prof is not None :
+        print '\nprofile of repeat ' + str(j) + ':\n' + prof.summary()
+        d['profile'] = prof.to_dict()
+    return d
 
+def phase(I, support, params, good_pix = None, sample_known = None, resume = False):
     # move all of the phasing params to the top level
     for k in params.keys():
         if k != 'phasing_parameters':
@@ -64,57 +376,73 @@ def phase(I, support, params, good_pix = None, sample_known = None):
 
     elif params['phasing']['mapper'] == 'ellipse' :
         params['phasing_parameters']['Mapper'] = Mapper_ellipse
-
-    params0 = copy.deepcopy(params)
     
-    alg_iters = config_iters_to_alg_num(params['phasing']['iters'])
+    # share the large read only arrays with the workers
+    shared = {'I'       : share(I), 
+              'mask'    : share(params['phasing_parameters'].pop('mask')),
+              'support' : share(params['phasing_parameters'].pop('support')),
+              'resume'  : resume}
+    
+    # one random seed for each repeat (from 'seed' if given)
+    repeats = params['phasing']['repeats']
+    seed    = params['phasing'].get('seed', None)
+    seeds   = np.random.RandomState(seed).randint(0, 2**31 - 1, size = repeats)
     
     # Repeats
     #---------------------------------------------
-    for j in range(params['phasing']['repeats']):
-        out.append(copy.deepcopy(d))
-        params = copy.deepcopy(params0)
-        
-        # for testing
-        # params['phasing_parameters']['O'] = np.roll(sample_known, -4, 1) #* np.random.random(sample_known.shape)
-        for alg, iters in alg_iters :
-            
-            if alg == 'ERA':
-               O, info = phasing_3d.ERA(I, iters, **params['phasing_parameters'])
-             
-            if alg == 'DM':
-               O, info = phasing_3d.DM(I,  iters, **params['phasing_parameters'])
-             
-            if alg == 'cheshireScan':
-               mapper  = params['phasing_parameters']['Mapper'](I, **params['phasing_parameters'])
-               O, info = mapper.scans_cheshire(O)
-            
-            out[j]['O']           = params['phasing_parameters']['O']          = O
-            out[j]['support']     = params['phasing_parameters']['support']    = info['support']
-            out[j]['eMod']       += info['eMod']
-            out[j]['eCon']       += info['eCon']
-            
-            if 'background' in info.keys():
-                out[j]['background']  = params['phasing_parameters']['background'] = info['background'] * good_pix
-                out[j]['B_rav']       = info['r_av']
+    processes = params['phasing'].get('processes', None)
+    if processes is None :
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, repeats)
     
-        out[j]['I'] = info['I']
-        out[j]['eMod'] = np.array(out[j]['eMod'])
-        out[j]['eCon'] = np.array(out[j]['eCon'])
+    if processes <= 1 or params['phasing_parameters']['hardware'] == 'gpu':
+        _init_worker(params, shared)
+        out = [phase_repeat(j, seeds[j]) for j in range(repeats)]
+    else :
+        # share the cores between the workers (unless fft_threads is set)
+        if params['phasing_parameters'].get('fft_threads', None) in [None, False] :
+            params['phasing_parameters']['fft_threads'] = max(1, multiprocessing.cpu_count() // processes)
+
+        print 'running', repeats, 'repeats with', processes, 'processes and', \
+              params['phasing_parameters']['fft_threads'], 'fft threads per process'
+        pool = multiprocessing.Pool(processes, _init_worker, (params, shared))
+        out  = pool.map(_phase_repeat, [(j, seeds[j]) for j in range(repeats)])
+        pool.close()
+        pool.join()
     return out
 
+def _phase_repeat(args):
+    return phase_repeat(*args)
 
-if __name__ == "__main__":
-    args = utils.io_utils.parse_cmdline_args_phasing()
-    
-    # read the h5 file
-    kwargs = utils.io_utils.read_input_output_h5(args.input)
-    
-    print kwargs.keys()
-    out = phase(kwargs['data'], kwargs['sample_support'], kwargs['config_file'], \
-                        good_pix = kwargs['good_pix'], sample_known = kwargs['solid_unit'])
+def stack_repeats(out):
+    """
+    Return the best repeat (lowest final modulus error) and the
+    results of every repeat stacked along the first axis.
+    """
+    best    = np.argmin([o['eMod'][-1] if len(o['eMod']) > 0 else np.inf for o in out])
+    stacked = {}
+    for k in ['O', 'I', 'support', 'eMod', 'eCon']:
+        if all([o[k] is not None for o in out]):
+            stacked[k] = np.array([o[k] for o in out])
+        else :
+            stacked[k] = None
+    return out[best], stacked
+
+
+def main(kwargs, resume = False):
+    """
+    Phase the data in kwargs then write output.h5 to the output path. 
+    kwargs is the output of utils.io_utils.read_input_output_h5 or, when 
+    run in the same process as the simulation (see run_crystals.py), a
+    dictionary with the same keys: data, sample_support, good_pix, 
+    solid_unit, config_file (the parsed parameters) and config_file_name.
+    """
+    repeats = phase(kwargs['data'], kwargs['sample_support'], kwargs['config_file'], \
+                        good_pix = kwargs['good_pix'], sample_known = kwargs['solid_unit'], \
+                        resume = resume)
     
-    out = out[0]
+    # the best repeat and every repeat (stacked)
+    out, stacked = stack_repeats(repeats)
 
     # write the h5 file 
     fnam = os.path.join(kwargs['config_file']['output']['path'], 'output.h5')
@@ -122,4 +450,23 @@ if __name__ == "__main__":
             data_retrieved = out['I'], sample_support = kwargs['sample_support'], \
             sample_support_retrieved = out['support'], good_pix = kwargs['good_pix'], \
             solid_unit = kwargs['solid_unit'], solid_unit_retrieved = out['O'], modulus_error = out['eMod'], \
-            fidelity_error = out['eCon'], config_file = kwargs['config_file_name'], B_rav = out['B_rav'])
+            fidelity_error = out['eCon'], config_file = kwargs['config_file_name'], B_rav = out['B_rav'], \
+            data_retrieved_repeats = stacked['I'], sample_support_retrieved_repeats = stacked['support'], \
+            solid_unit_retrieved_repeats = stacked['O'], modulus_error_repeats = stacked['eMod'], \
+            fidelity_error_repeats = stacked['eCon'], stage_stops = np.array(out['stops'], dtype = stops_dtype), \
+            **utils.io_utils.h5_options(kwargs['config_file']))
+    
+    # timing and memory of each stage
+    if out['profile'] is not None :
+        utils.profiling.write_h5(fnam, [r['profile'] for r in repeats])
+    return out
+
+
+if __name__ == "__main__":
+    args = utils.io_utils.parse_cmdline_args_phasing()
+    
+    # read the h5 file
+    kwargs = utils.io_utils.read_input_output_h5(args.input)
+    
+    print kwargs.keys()
+    main(kwargs, args.resume)
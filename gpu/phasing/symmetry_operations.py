@@ -4,56 +4,46 @@ from itertools import product
 
 import crappy_crystals
 from crappy_crystals.phasing.symmetry_operations import *
+from crappy_crystals.phasing import symmetry_operations as sym_ops_cpu
 
-class P1():
+def gather(a, g):
     """
-    Store arrays to make the crystal mapping more
-    efficient.
+    Apply the compiled gather g (see compile_gather) to the afnumpy array a
+    and return the arrayfire array.
 
-    Assume that Fourier space arrays are fft shifted.
+    arrayfire dimensions are the numpy axes in reverse order (dim = ndim-1-axis)
+    and a flip in the np.fft.fftfreq basis is a flip followed by a shift of 1.
+    """
+    if g['conj'] :
+        raise ValueError('conjugating gathers (rfft) are not supported on the gpu')
 
-    Perform symmetry operations with the np.fft.fftfreq basis
-    so that (say) a flip operation behaves like:
-    a         = [0, 1, 2, 3, 4, 5, 6, 7]
-    a flipped = [0, 7, 6, 5, 4, 3, 2, 1]
+    n = len(a.shape)
+    u = a.d_array
+    if tuple(g['axes']) != tuple(range(n)) :
+        dims = [n-1-g['axes'][n-1-d] for d in range(n)] + list(range(n, 4))
+        u = afnumpy.arrayfire.data.reorder(u, *dims)
 
-    or:
-    i         = np.fft.fftfreq(8)*8
-              = [ 0,  1,  2,  3, -4, -3, -2, -1]
-    i flipped = [ 0, -1, -2, -3, -4,  3,  2,  1]
-    """
-    def __init__(self, unitcell_size, det_shape, dtype=np.complex128):
-        # store the tranlation ramps
-        # x = x
-        T0 = 1
-        
-        self.translations = afnumpy.array([T0])
-        
-        # keep an array for the 1 symmetry related coppies of the solid unit
-        self.syms = afnumpy.zeros((1,) + tuple(det_shape), dtype=dtype)
-    
-    def solid_syms_Fourier(self, solid, apply_translation = True):
-        """
-        Take the Fourier space solid unit then return each
-        of the symmetry related partners.
-        """
-        # x = x
-        self.syms[0] = solid
-        
-        self.syms *= self.translations
-        return self.syms
+    shifts = [0, 0, 0, 0]
+    for ax in g['flips'] :
+        u = afnumpy.arrayfire.data.flip(u, dim=n-1-ax)
+        shifts[n-1-ax] = 1
 
-    def solid_syms_real(self, solid):
-        # x = x
-        self.syms[0] = solid
-        return self.syms
+    if any(shifts) :
+        u = afnumpy.arrayfire.data.shift(u, shifts[0], d1=shifts[1], d2=shifts[2], d3=shifts[3])
+    return u
 
-    def unflip_modes_Fourier(self, U, apply_translation = True):
-        out = afnumpy.empty_like(U)
-        out[0] = U[0]
-        return out
+def stack(us, shape):
+    """
+    join the arrayfire arrays us (each of numpy shape 'shape') into
+    an afnumpy array of shape (len(us),) + shape
+    """
+    U = us[0]
+    for u in us[1:] :
+        U = afnumpy.arrayfire.data.join(len(shape), U, u)
+    U = afnumpy.arrayfire.data.moddims(U, *(tuple(shape[::-1]) + (len(us),)))
+    return afnumpy.asarray(U)
 
-class P212121():
+class Space_group():
     """
     Store arrays to make the crystal mapping more
     efficient.
@@ -69,84 +59,72 @@ class P212121():
     i         = np.fft.fftfreq(8)*8
               = [ 0,  1,  2,  3, -4, -3, -2, -1]
     i flipped = [ 0, -1, -2, -3, -4,  3,  2,  1]
+
+    The operators are compiled with the cpu code (see
+    crappy_crystals.phasing.symmetry_operations.compile_ops) and each
+    gather is applied as an arrayfire reorder, flips and shifts (see gather).
     """
-    def __init__(self, unitcell_size, det_shape, dtype=np.complex128):
-        # only calculate the translations when they are needed
-        self.translations = None
-        
+    def __init__(self, space_group, unitcell_size, det_shape, dtype=np.complex128):
+        if space_group not in space_groups :
+            raise ValueError('unknown space group: ' + str(space_group) + \
+                             ' (choose from ' + str(sorted(space_groups.keys())) + ')')
+
+        self.space_group   = space_group
         self.unitcell_size = unitcell_size
-        self.det_shape     = det_shape
-        
-        # keep an array for the 4 symmetry related coppies of the solid unit
-        self.syms = afnumpy.zeros((4,) + tuple(det_shape), dtype=dtype)
+        self.det_shape     = tuple(det_shape)
+        self.dtype         = dtype
+
+        # only calculate the translations when they are needed
+        self.translations     = None
+        self.translations_inv = None
+
+        self.ops = compile_ops(space_group, det_shape)
+
+        # keep an array for the symmetry related coppies of the solid unit
+        self.syms = afnumpy.zeros((len(self.ops),) + self.det_shape, dtype=dtype)
 
     def make_Ts(self):
-        det_shape     = self.det_shape
-        unitcell_size = self.unitcell_size
-        # store the tranlation ramps
-        # x = x
-        T0 = np.ones(det_shape, dtype=np.complex128)
-        # x = 0.5 + x, 0.5 - y, -z
-        T1 = T_fourier(det_shape, [unitcell_size[0]/2., unitcell_size[1]/2., 0.0])
-        # x = -x, 0.5 + y, 0.5 - z
-        T2 = T_fourier(det_shape, [0.0, unitcell_size[1]/2., unitcell_size[2]/2.])
-        # x = 0.5 - x, -y, 0.5 + z
-        T3 = T_fourier(det_shape, [unitcell_size[0]/2., 0.0, unitcell_size[2]/2.])
-        self.translations = afnumpy.array([T0, T1, T2, T3])
-    
+        # store the tranlation ramps (full volumes)
+        Ts, Ts_inv = [], []
+        for op in self.ops :
+            T = np.ones(self.det_shape, dtype=self.dtype)
+            for t in T_fourier_factors(self.det_shape, op['T'] * np.array(self.unitcell_size, dtype=float)):
+                T *= t
+
+            # the translations for the unflipped modes : unflip(T*)
+            Ts.append(T)
+            Ts_inv.append(sym_ops_cpu.gather(np.conj(T), op['inv']))
+
+        self.translations     = afnumpy.array(np.array(Ts))
+        self.translations_inv = afnumpy.array(np.array(Ts_inv))
+
     def solid_syms_Fourier(self, solid, apply_translation = True):
-        # x = 0.5 + x, 0.5 - y, -z
-        u1 = afnumpy.arrayfire.data.flip(solid.d_array, dim=1)
-        u1 = afnumpy.arrayfire.data.flip(u1, dim=0)
-        u1 = afnumpy.arrayfire.data.shift(u1, 1, d1=1)
-
-        # x = -x, 0.5 + y, 0.5 - z
-        u2 = afnumpy.arrayfire.data.flip(solid.d_array, dim=2)
-        u2 = afnumpy.arrayfire.data.flip(u2, dim=0)
-        u2 = afnumpy.arrayfire.data.shift(u2, 1, d2=1)
-
-        # x = 0.5 - x, -y, 0.5 + z
-        u3 = afnumpy.arrayfire.data.flip(solid.d_array, dim=2)
-        u3 = afnumpy.arrayfire.data.flip(u3, dim=1)
-        u3 = afnumpy.arrayfire.data.shift(u3, 0, d1=1, d2=1)
-
-        U = afnumpy.arrayfire.data.join(3, solid.d_array, u1, u2, u3)
-        U = afnumpy.arrayfire.data.moddims(U, self.syms.shape[3],self.syms.shape[2],self.syms.shape[1],self.syms.shape[0])
-        self.syms = afnumpy.asarray(U)
-        
+        """
+        Take the Fourier space solid unit then return each
+        of the symmetry related partners.
+        """
+        self.syms = stack([gather(solid, op['fwd']) for op in self.ops], self.det_shape)
+
         if apply_translation :
             if self.translations is None :
                 self.make_Ts()
-            
+
             self.syms *= self.translations
         return self.syms
 
     def unflip_modes_Fourier(self, U, apply_translation = True):
-        # x = 0.5 + x, 0.5 - y, -z
-        u1 = afnumpy.arrayfire.data.flip(U[1].d_array, dim=1)
-        u1 = afnumpy.arrayfire.data.flip(u1, dim=0)
-        u1 = afnumpy.arrayfire.data.shift(u1, 1, d1=1)
-
-        # x = -x, 0.5 + y, 0.5 - z
-        u2 = afnumpy.arrayfire.data.flip(U[2].d_array, dim=2)
-        u2 = afnumpy.arrayfire.data.flip(u2, dim=0)
-        u2 = afnumpy.arrayfire.data.shift(u2, 1, d2=1)
-
-        # x = 0.5 - x, -y, 0.5 + z
-        u3 = afnumpy.arrayfire.data.flip(U[3].d_array, dim=2)
-        u3 = afnumpy.arrayfire.data.flip(u3, dim=1)
-        u3 = afnumpy.arrayfire.data.shift(u3, 0, d1=1, d2=1)
-
-        U_inv = afnumpy.arrayfire.data.join(3, U[0].d_array, u1, u2, u3)
-        U_inv = afnumpy.arrayfire.data.moddims(U_inv, self.syms.shape[3],self.syms.shape[2],self.syms.shape[1],self.syms.shape[0])
-        U_inv = afnumpy.asarray(U_inv)
-        
+        """
+        The inverse of solid_syms_Fourier for each of the
+        symmetry related partners in U.
+        """
+        U_inv = stack([gather(U[n], op['inv']) for n, op in enumerate(self.ops)], self.det_shape)
 
+        # unflip(U T*) = unflip(U) unflip(T*)
         if apply_translation :
             if self.translations is None :
                 self.make_Ts()
-            
-            U_inv *= self.translations.conj()
+
+            U_inv *= self.translations_inv
         return U_inv
 
     def solid_syms_real(self, solid):
@@ -154,37 +132,26 @@ class P212121():
         This uses pixel shifts (not phase ramps) for translation.
         Therefore sub-pixel shifts are ignored.
         """
-        translations = []
-        translations.append([self.unitcell_size[0]/2, self.unitcell_size[1]/2, 0])
-        translations.append([0, self.unitcell_size[1]/2, self.unitcell_size[2]/2])
-        translations.append([self.unitcell_size[0]/2, 0, self.unitcell_size[2]/2])
-        
-        # x = 0.5 + x, 0.5 - y, -z
-        u1 = afnumpy.arrayfire.data.flip(solid.d_array, dim=1)
-        u1 = afnumpy.arrayfire.data.flip(u1, dim=0)
-        u1 = afnumpy.arrayfire.data.shift(u1, 1, d1=1)
-        
-        t  = translations[0]
-        u1 = afnumpy.arrayfire.data.shift(u1, t[-1], d1=t[-2], d2=t[-3])
-
-        # x = -x, 0.5 + y, 0.5 - z
-        u2 = afnumpy.arrayfire.data.flip(solid.d_array, dim=2)
-        u2 = afnumpy.arrayfire.data.flip(u2, dim=0)
-        u2 = afnumpy.arrayfire.data.shift(u2, 1, d2=1)
-
-        t  = translations[1]
-        u2 = afnumpy.arrayfire.data.shift(u2, t[-1], d1=t[-2], d2=t[-3])
-
-        # x = 0.5 - x, -y, 0.5 + z
-        u3 = afnumpy.arrayfire.data.flip(solid.d_array, dim=2)
-        u3 = afnumpy.arrayfire.data.flip(u3, dim=1)
-        u3 = afnumpy.arrayfire.data.shift(u3, 0, d1=1, d2=1)
-        
-        t  = translations[2]
-        u3 = afnumpy.arrayfire.data.shift(u3, t[-1], d1=t[-2], d2=t[-3])
-
-        U = afnumpy.arrayfire.data.join(3, solid.d_array, u1, u2, u3)
-        U = afnumpy.arrayfire.data.moddims(U, self.syms.shape[3],self.syms.shape[2],self.syms.shape[1],self.syms.shape[0])
-        U = afnumpy.asarray(U)
-        
-        return U
+        n  = len(self.det_shape)
+        us = []
+        for op in self.ops :
+            u = gather(solid, op['real'])
+
+            t = list(np.floor(op['T'] * np.array(self.unitcell_size)).astype(int))[::-1] + [0] * (4-n)
+            if np.any(t) :
+                u = afnumpy.arrayfire.data.shift(u, t[0], d1=t[1], d2=t[2], d3=t[3])
+            us.append(u)
+        return stack(us, self.det_shape)
+
+
+class P1(Space_group):
+    def __init__(self, unitcell_size, det_shape, dtype=np.complex128):
+        Space_group.__init__(self, 'P1', unitcell_size, det_shape, dtype)
+
+
+class P212121(Space_group):
+    """
+    see p212121diagramme.gif
+    """
+    def __init__(self, unitcell_size, det_shape, dtype=np.complex128):
+        Space_group.__init__(self, 'P212121', unitcell_size, det_shape, dtype)
@@ -4,7 +4,8 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 
-from libc.math cimport sin, cos, acos, exp, sqrt, fabs, M_PI
+cimport cython
+from libc.math cimport sin, cos, acos, exp, sqrt, fabs, fmax, M_PI
 
 def project_2D_Ellipse_cython(double e0, double e1, double x, double y, bint e0_inf = 0, bint e1_inf = 0):
     """
@@ -60,41 +61,82 @@ def project_2D_Ellipse_cython(double e0, double e1, double x, double y, bint e0_
         The y-coordinate of the closest point to (x, y) that
         lies on the ellipse surface.
     """
+    cdef double u, v
+    _project_2D_Ellipse(e0, e1, x, y, e0_inf, e1_inf, &u, &v)
+    return u, v
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def project_2D_Ellipse_arrays_cython(double[::1] e0, double[::1] e1, double[::1] x, double[::1] y, 
+                                     unsigned char[::1] e0_inf, unsigned char[::1] e1_inf, 
+                                     double[::1] u, double[::1] v):
+    """
+    Solve the ellipse projection problem for every element of 
+    the (flat, contiguous) input arrays in a single call.
+
+    This is the array version of project_2D_Ellipse_cython, the
+    arguments are the same except that they are 1D arrays and the 
+    result is written into u and v. The e0_inf and e1_inf masks
+    must be passed as np.uint8 (e.g. bool_array.view(np.uint8)).
+
+    The loop runs without the GIL and gives identical results to 
+    calling project_2D_Ellipse_cython on each element.
+    """
+    cdef Py_ssize_t n, N = x.shape[0]
+    
+    if not (e0.shape[0] == e1.shape[0] == y.shape[0] == N and \
+            e0_inf.shape[0] == e1_inf.shape[0] == u.shape[0] == v.shape[0] == N):
+        raise ValueError('all arrays must have the same length')
+    
+    with nogil :
+        for n in range(N):
+            _project_2D_Ellipse(e0[n], e1[n], x[n], y[n], e0_inf[n], e1_inf[n], &u[n], &v[n])
+
+
+@cython.cdivision(True)
+cdef inline void _project_2D_Ellipse(double e0, double e1, double x, double y, 
+                                     bint e0_inf, bint e1_inf, double *u_out, double *v_out) noexcept nogil:
     cdef double s0, s1, s, ratio0, ratio1, g, n0, n1, r0, r1
+    cdef double ep0, ep1, xp, yp, z0, z1, nn, u, v, I, tol
+    cdef bint flipped, x_inv, y_inv
+    cdef int i
 
     if e0_inf and e1_inf :
-        return x, y
+        u_out[0] = x
+        v_out[0] = y
+        return
     
     elif e0_inf :
-        u = x
+        u_out[0] = x
         if y < 0 :
-            v = -e1
+            v_out[0] = -e1
         else :
-            v = e1
-        return u, v
+            v_out[0] = e1
+        return
             
     elif e1_inf :
-        v = y
+        v_out[0] = y
         if x < 0 :
-            u = -e0
+            u_out[0] = -e0
         else :
-            u = e0
-        return u, v
+            u_out[0] = e0
+        return
     
     elif e0 == 0.0 and e1 == 0.0 :
-        u = 0.0
-        v = 0.0
-        return u, v
+        u_out[0] = 0.0
+        v_out[0] = 0.0
+        return
     
     elif e0 == 0.0 :
-        u = 0.0
-        v = y
-        return u, v
+        u_out[0] = 0.0
+        v_out[0] = y
+        return
     
     elif e1 == 0.0 :
-        u = x
-        v = 0.0
-        return u, v
+        u_out[0] = x
+        v_out[0] = 0.0
+        return
         
         
     # sort axes so that e0 > e1 
@@ -159,12 +201,10 @@ def project_2D_Ellipse_cython(double e0, double e1, double x, double y, bint e0_
         s1 = 0. 
     else  :
         # calculate the 'robust length' of r * z
-        nn = max(n0, n1)
-        s1 = abs(nn) * sqrt( (n0/nn)**2 + (n1/nn)**2 ) -1.
+        nn = fmax(n0, n1)
+        s1 = fabs(nn) * sqrt( (n0/nn)**2 + (n1/nn)**2 ) -1.
     s = 0.
     
-    #print('s0, s1, r0, r1, s+r0, s+r1, ep0, ep1, xp, yp, z1', s0, s1, r0, r1, s+r0, s+r1, ep0, ep1, xp, yp, z1)
-
     for i in range(2074): # 1074, 149 for double, single precision
         s = (s0 + s1) / 2.
         if s == s0 or s == s1 :
@@ -182,8 +222,6 @@ def project_2D_Ellipse_cython(double e0, double e1, double x, double y, bint e0_
     u = r0 * xp / (s + r0)
     v = r1 * yp / (s + r1)
     
-    #print(x_out, y_out, xp, yp, ep0, ep1, g)
-    
     # do an additional projection onto the ellipse surface
     # for numerical stability when xp or yp ~ 0
     I = sqrt((u/ep0)**2 + (v/ep1)**2)
@@ -199,6 +237,8 @@ def project_2D_Ellipse_cython(double e0, double e1, double x, double y, bint e0_
     
     # unflip
     if flipped :
-        return v, u
+        u_out[0] = v
+        v_out[0] = u
     else :
-        return u, v
+        u_out[0] = u
+        v_out[0] = v
@@ -4,11 +4,13 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import numpy as np
+import multiprocessing
 import sys
 
 import crappy_crystals
 import crappy_crystals.utils.disorder
 from   crappy_crystals.utils.disorder import make_exp
+from   crappy_crystals.utils.fft_backend import get_fft
 #import crappy_crystals.phasing.symmetry_operations as symmetry_operations 
 from . import symmetry_operations 
 #import crappy_crystals.utils.l2norm
@@ -21,19 +23,36 @@ from phasing_3d.src.mappers import isValid
 
 
 import pyximport; pyximport.install()
-from .ellipse_2D_cython import project_2D_Ellipse_cython
+from .ellipse_2D_cython import project_2D_Ellipse_cython, project_2D_Ellipse_arrays_cython
+from .modulus_cython import pmod_emod_cython, emod_cython
 
-def get_sym_ops(params):
+def get_dtypes(params):
+    """
+    Return the real and complex dtypes (e.g. np.float32, np.complex64) 
+    from the 'dtype' and 'c_dtype' entries of params. dtype may also be
+    'single' or 'double' (as in config.ini), if c_dtype is not given 
+    then it has the precision of dtype. The default is double precision.
+    """
+    dtype = np.float64
+    if isValid('dtype', params) :
+        dtype = {'single' : np.float32, 'double' : np.float64}.get(params['dtype'], params['dtype'])
+    dtype = np.dtype(dtype).type
+    
+    if isValid('c_dtype', params) :
+        c_dtype = np.dtype(params['c_dtype']).type
+    else :
+        c_dtype = np.result_type(dtype, np.complex64).type
+    return dtype, c_dtype
 
-    if params['crystal']['space_group'] == 'P1':
-        print('\ncrystal space group: P1')
-        sym_ops = \
-            symmetry_operations.P1(params['crystal']['unit_cell'], params['detector']['shape'])
+def get_sym_ops(params):
+    rfft = isValid('real_object', params)
+    dtype, c_dtype = get_dtypes(params)
 
-    elif params['crystal']['space_group'] == 'P212121':
-        print('\ncrystal space group: P212121')
-        sym_ops = \
-            symmetry_operations.P212121(params['crystal']['unit_cell'], params['detector']['shape'])
+    space_group = params['crystal']['space_group']
+    print('\ncrystal space group:', space_group)
+    sym_ops = \
+        symmetry_operations.Space_group(space_group, params['crystal']['unit_cell'], params['detector']['shape'], \
+                                        dtype = c_dtype, rfft = rfft)
 
     return sym_ops
 
@@ -92,6 +111,10 @@ class Mapper_naive():
         alpha : float, optional, default (1.0e-10)
             A floating point number to regularise array division (prevents 1/0 errors).
         
+        real_object : bool, optional, default (False)
+            If True then the object is real and only the non-negative frequencies 
+            of the last axis are stored and updated (np.fft.rfftn), see Half_spectrum.
+        
         disorder['sigma'] : float
             The standard deviation of the isotropic displacement of the solid unit within
             the crystal.
@@ -118,23 +141,30 @@ class Mapper_naive():
         """
         # dtype
         #-----------------------------------------------
-        if isValid('dtype', args) :
-            dtype = args['dtype']
-        else :
-            dtype = np.float64
+        dtype, c_dtype = get_dtypes(args)
         
-        if isValid('c_dtype', args) :
-            c_dtype = args['c_dtype']
-        else :
-            c_dtype = np.complex128
+        # fft routines (numpy, scipy or pyfftw)
+        #-----------------------------------------------
+        self.fft = get_fft(args)
+        
+        # real object: only store half of the last axis
+        #-----------------------------------------------
+        self.shape = tuple(I.shape)
+        self.rfft  = isValid('real_object', args)
+        if self.rfft :
+            self.half = Half_spectrum(self.shape)
         
         # initialise the object
         #-----------------------------------------------
         if isValid('O', args):
-            modes = np.fft.fftn(args['O'])
+            if self.rfft :
+                modes = self.fft.rfftn(args['O'])
+            else :
+                modes = self.fft.fftn(args['O'])
         else :
             print('initialising object with random numbers')
-            modes = np.random.random(I.shape).astype(c_dtype)
+            modes = np.random.random(symmetry_operations.Fourier_shape(I.shape, self.rfft)).astype(c_dtype)
+        modes = modes.astype(c_dtype)
         
         # initialise the mask, alpha value and amp
         #-----------------------------------------------
@@ -149,11 +179,25 @@ class Mapper_naive():
         self.I_norm = (self.mask * I).sum()
         self.amp    = np.sqrt(I.astype(dtype))
         
+        # amplitudes and mask for the modulus projection
+        self.amp_P  = self.amp
+        self.mask_P = self.mask
+        if self.rfft :
+            self.amp, self.mask, self.amp_c, self.mask_c, self.amp_P, self.mask_P = \
+                    self.half.data(self.amp, self.mask)
+        
+        # flat float64 data for the modulus kernels (see modulus_cython)
+        if self.rfft :
+            self.mod_data = modulus_data(self.amp_P, self.mask_P, self.amp, self.mask, self.amp_c, self.mask_c, dtype)
+        else :
+            self.mod_data = modulus_data(self.amp_P, self.mask_P, self.amp, self.mask, dtype = dtype)
+        
         # define the support projection
         #-----------------------------------------------
         if isValid('voxel_number', args) :
             self.voxel_number = args['voxel_number']
             self.support = None
+            self.n_highest_pixels = N_highest_pixels(args['detector']['shape'])
         else :
             self.voxel_number = False
             #
@@ -165,65 +209,240 @@ class Mapper_naive():
         self.sym_ops = get_sym_ops(args)
         
         N          = args['disorder']['n']
-        exp        = make_exp(args['disorder']['sigma'], args['detector']['shape'])
-        lattice    = symmetry_operations.lattice(args['crystal']['unit_cell'], args['detector']['shape'])
+        exp        = make_exp(args['disorder']['sigma'], args['detector']['shape'], args.get('cache_dir', None))
+        lattice    = symmetry_operations.lattice(args['crystal']['unit_cell'], args['detector']['shape'], \
+                                                 cache_dir = args.get('cache_dir', None))
         #self.solid_syms = lambda x : sym_ops.solid_syms(x)
         
         self.unit_cell_weighting = N * lattice * exp
         self.diffuse_weighting   = (1. - exp)
         
+        self.unit_cell_weighting = self.unit_cell_weighting.astype(dtype)
+        self.diffuse_weighting   = self.diffuse_weighting.astype(dtype)
+        
+        if self.rfft :
+            self.unit_cell_weighting = self.half.half(self.unit_cell_weighting)
+            self.diffuse_weighting   = self.half.half(self.diffuse_weighting)
+        
+        # the unit cell term is zero away from the reciprocal lattice
+        self.lattice_index, self.unit_cell_weighting_L = lattice_index(self.unit_cell_weighting)
+        self.lattice_syms = self.sym_ops.solid_syms_index(self.lattice_index)
+        
         self.modes = modes
+        
+        # Imap and the modulus error of the last modes passed to 
+        # Pmod or Emod (see Imap_eMod)
+        self.Imap_modes = None
+        self.Imap_cache = None
+        self.eMod       = None
          
     def object(self, modes):
-        out = np.fft.ifftn(modes)
+        if self.rfft :
+            return self.fft.irfftn(modes, self.shape)
+        
+        out = self.fft.ifftn(modes)
         return out
 
     def Imap(self, modes):
         # 'modes' is just our object in Fourier space
-        Us = self.sym_ops.solid_syms_Fourier(modes)
-        U  = np.sum(Us, axis=0)
+        # the translations are phase factors so the diffuse term 
+        # only needs the symmetry partners of |modes|^2
+        I  = self.sym_ops.solid_syms_sum( (modes * modes.conj()).real )
+        I *= self.diffuse_weighting
         
-        I  = self.diffuse_weighting   * np.sum( (Us * Us.conj()).real, axis=0)
-        I += self.unit_cell_weighting * (U * U.conj()).real
+        # unit cell term on the lattice voxels only
+        U  = lattice_sum_syms(modes, self.lattice_syms)
+        I.reshape(-1)[self.lattice_index] += self.unit_cell_weighting_L * (U * U.conj()).real
         return I
     
     def Psup(self, modes):
-        out = modes.copy()
-        out = np.fft.ifftn(out)
+        if self.rfft :
+            out = self.fft.irfftn(modes, self.shape)
+        else :
+            out = self.fft.ifftn(modes)
 
         if self.voxel_number :
-            self.S = choose_N_highest_pixels( (out * out.conj()).real, self.voxel_number, support = self.support)
+            self.S = self.n_highest_pixels( (out * out.conj()).real, self.voxel_number, support = self.support)
 
         out *= self.S
-        out = np.fft.fftn(out)
+        
+        if self.rfft :
+            out = self.fft.rfftn(out)
+        else :
+            out = self.fft.fftn(out)
         return out
 
+    def Imap_eMod(self, modes):
+        """
+        Return Imap(modes) and the modulus error of modes if they were 
+        evaluated for this same array (object) by the last call of Pmod 
+        or Emod, otherwise (None, None). 
+        
+        In ERA the modes returned by Psup are passed to Emod and then to
+        Pmod, so Pmod reuses the Imap of Emod. The modes must not be 
+        modified in place between these calls.
+        """
+        if modes is self.Imap_modes :
+            return self.Imap_cache, self.eMod
+        return None, None
+    
     def Pmod(self, modes):
-        out = modes.copy()
-        M   = self.Imap(out)
-        out = pmod_naive(self.amp, M, modes, self.mask, alpha = self.alpha)
+        """
+        The modulus projection (see pmod_naive), the modulus error 
+        of modes is evaluated in the same pass (see Imap_eMod).
+        """
+        M, eMod = self.Imap_eMod(modes)
+        if M is None :
+            M = self.Imap(modes)
+        
+        out = np.empty(modes.shape, dtype=modes.dtype)
+        err = pmod_emod_cython(np.ascontiguousarray(modes).ravel(), M.ravel(), 
+                               *(self.mod_data + [self.alpha, out.ravel()]))
+        
+        self.Imap_modes, self.Imap_cache = modes, M
+        self.eMod = np.sqrt( err / self.I_norm )
         return out
     
     def Emod(self, modes):
+        M, eMod = self.Imap_eMod(modes)
+        if eMod is not None :
+            return eMod
+        
         M         = self.Imap(modes)
-        eMod      = np.sum( self.mask * ( np.sqrt(M) - self.amp )**2 )
+        # the -q voxels that are not stored are included in rfft mode
+        eMod      = emod_cython(M.ravel(), *self.mod_data[2:])
         eMod      = np.sqrt( eMod / self.I_norm )
+        
+        self.Imap_modes, self.Imap_cache, self.eMod = modes, M, eMod
         return eMod
 
     def finish(self, modes):
         out = {}
         out['support'] = self.S
         out['I']       = self.Imap(modes)
+        if self.rfft :
+            out['I'] = self.half.full(out['I'])
         return out
 
     def l2norm(self, delta, array0):
         num = 0
         den = 0
-        num += np.sum( (delta * delta.conj()).real ) 
-        den += np.sum( (array0 * array0.conj()).real ) 
+        if self.rfft :
+            num += self.half.sum( (delta * delta.conj()).real ) 
+            den += self.half.sum( (array0 * array0.conj()).real ) 
+        else :
+            num += np.sum( (delta * delta.conj()).real, dtype=np.float64 ) 
+            den += np.sum( (array0 * array0.conj()).real, dtype=np.float64 ) 
         return np.sqrt(num / den)
      
 
+def lattice_index(unit_cell_weighting):
+    """
+    Return the flat indices of the voxels where unit_cell_weighting
+    is non-zero (the reciprocal lattice) and the weighting there.
+    """
+    index = np.flatnonzero(unit_cell_weighting)
+    return index, unit_cell_weighting.ravel()[index]
+
+def lattice_sum_syms(solid, syms_index):
+    """
+    sum_i solid_syms_Fourier(solid)[i] evaluated at the lattice voxels
+    only, where syms_index = sym_ops.solid_syms_index(lattice index).
+    """
+    i, c, T = syms_index
+    Us = solid.ravel()[i]
+    Us[c] = Us[c].conj()
+    return np.sum(Us * T, axis=0)
+
+def modulus_data(amp_P, mask_P, amp, mask, amp_c = None, mask_c = None, dtype = np.float64):
+    """
+    Return flat, contiguous copies (of type dtype) of the data for the 
+    kernels in modulus_cython (scalar masks are broadcast to the shape 
+    of amp), amp_c and mask_c are empty if None.
+    """
+    out = []
+    for a in [amp_P, mask_P, amp, mask, amp_c, mask_c]:
+        if a is None :
+            out.append(np.empty((0,), dtype=dtype))
+        else :
+            out.append(np.ascontiguousarray(np.broadcast_to(a, amp.shape), dtype=dtype).ravel())
+    return out
+
+def lattice_sum(Us, index):
+    """
+    sum_i Us[i] evaluated at the flat voxel indices 'index' only.
+    """
+    Us = np.ascontiguousarray(Us)
+    return np.sum(Us.reshape((Us.shape[0], -1))[:, index], axis=0)
+
+
+class Half_spectrum():
+    """
+    Book keeping for the Fourier space arrays of a real object, where 
+    only the non-negative frequencies of the last axis are stored 
+    (np.fft.rfftn). For a real object O(-q) = O*(q), so every stored 
+    voxel with 0 < k < n/2 also stands for the voxel at -q, while the
+    k = 0 (and k = n/2 for even n) planes contain both q and -q.
+    """
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        n          = self.shape[-1]
+        self.h     = n//2 + 1
+        
+        # 1 if the -q voxel is not stored, 0 otherwise
+        self.partner = np.ones((self.h,), dtype=np.float64)
+        self.partner[0] = 0.
+        if n % 2 == 0 :
+            self.partner[-1] = 0.
+        
+        # the number of voxels that each stored voxel stands for
+        self.weights = 1. + self.partner
+
+    def half(self, a):
+        """a full array --> the stored half"""
+        return np.ascontiguousarray(a[..., : self.h])
+
+    def half_conj(self, a):
+        """a full array --> a(-q) on the stored half"""
+        a = symmetry_operations.multiroll(a[::-1, ::-1, ::-1], [1, 1, 1])
+        return self.half(a)
+
+    def full(self, a):
+        """a stored half --> the full array, using a(-q) = a*(q)"""
+        out = np.empty(self.shape, dtype=a.dtype)
+        out[..., : self.h] = a
+        b = symmetry_operations.multiroll(a[::-1, ::-1, :], [1, 1, 0])
+        out[..., self.h :] = b[..., self.shape[-1] - self.h : 0 : -1].conj()
+        return out
+
+    def sum(self, a):
+        """the sum of the full array given the stored half of a (in double precision)"""
+        return np.sum(self.weights * a, dtype=np.float64)
+
+    def data(self, amp, mask = 1):
+        """
+        Split the measured amplitudes into the values at the stored voxels
+        (amp, mask) and at the -q voxels that are not stored (amp_c, mask_c),
+        so that the modulus error can be evaluated over the full volume.
+
+        Because the model intensity is the same at q and -q, the modulus 
+        projection uses the least squares amplitude of the pair (amp_P) 
+        which is valid where either of the two is (mask_P).
+        """
+        mask   = np.broadcast_to(mask, self.shape).astype(np.bool)
+        amp_c  = self.half_conj(amp)
+        mask_c = self.half_conj(mask)
+        amp    = self.half(amp)
+        mask   = self.half(mask)
+        
+        n      = mask.astype(amp.dtype) + mask_c
+        amp_P  = (mask * amp + mask_c * amp_c) / np.maximum(n, 1)
+        mask_P = n > 0
+        
+        mask_c = mask_c * self.partner
+        return amp, mask, amp_c, mask_c, amp_P, mask_P
+
+
 def pmod_naive(amp, M, O, mask = 1, alpha = 1.0e-10):
     out  = mask * O * amp / np.sqrt(M + alpha)
     out += (1 - mask) * O
@@ -237,23 +456,30 @@ class Mapper_ellipse():
         """
         # dtype
         #-----------------------------------------------
-        if isValid('dtype', args) :
-            dtype = args['dtype']
-        else :
-            dtype = np.float64
-        
-        if isValid('c_dtype', args) :
-            c_dtype = args['c_dtype']
-        else :
-            c_dtype = np.complex128
+        dtype, c_dtype = get_dtypes(args)
 
+        # fft routines (numpy, scipy or pyfftw)
+        #-----------------------------------------------
+        self.fft = get_fft(args)
+        
+        # real object: only store half of the last axis
+        #-----------------------------------------------
+        self.shape = tuple(I.shape)
+        self.rfft  = isValid('real_object', args)
+        if self.rfft :
+            self.half = Half_spectrum(self.shape)
+        
         # initialise the object
         #-----------------------------------------------
         if isValid('O', args):
-            O = np.fft.fftn(args['O'])
+            if self.rfft :
+                O = self.fft.rfftn(args['O'])
+            else :
+                O = self.fft.fftn(args['O'])
         else :
             print('initialising object with random numbers')
-            O = np.random.random(I.shape).astype(c_dtype)
+            O = np.random.random(symmetry_operations.Fourier_shape(I.shape, self.rfft)).astype(c_dtype)
+        O = O.astype(c_dtype)
 
         # initialise the mask, alpha value and amp
         #-----------------------------------------------
@@ -268,11 +494,25 @@ class Mapper_ellipse():
         self.I_norm = (self.mask * I).sum()
         self.amp    = np.sqrt(I.astype(dtype))
         
+        # amplitudes and mask for the modulus projection
+        self.amp_P  = self.amp
+        self.mask_P = self.mask
+        if self.rfft :
+            self.amp, self.mask, self.amp_c, self.mask_c, self.amp_P, self.mask_P = \
+                    self.half.data(self.amp, self.mask)
+        
+        # flat float64 data for the modulus kernels (see modulus_cython)
+        if self.rfft :
+            self.mod_data = modulus_data(self.amp_P, self.mask_P, self.amp, self.mask, self.amp_c, self.mask_c, dtype)
+        else :
+            self.mod_data = modulus_data(self.amp_P, self.mask_P, self.amp, self.mask, dtype = dtype)
+        
         # define the support projection
         #-----------------------------------------------
         if isValid('voxel_number', args) :
             self.voxel_number = args['voxel_number']
             self.support = None
+            self.n_highest_pixels = N_highest_pixels(args['detector']['shape'])
             self.S       = None
         else :
             self.voxel_number = False
@@ -285,18 +525,32 @@ class Mapper_ellipse():
         self.sym_ops = get_sym_ops(args)
         
         N          = args['disorder']['n']
-        exp        = make_exp(args['disorder']['sigma'], args['detector']['shape'])
-        lattice    = symmetry_operations.lattice(args['crystal']['unit_cell'], args['detector']['shape'])
+        exp        = make_exp(args['disorder']['sigma'], args['detector']['shape'], args.get('cache_dir', None))
+        lattice    = symmetry_operations.lattice(args['crystal']['unit_cell'], args['detector']['shape'], \
+                                                 cache_dir = args.get('cache_dir', None))
         self.unit_cell = args['crystal']['unit_cell']
 
         self.unit_cell_weighting = N * lattice * exp
         self.diffuse_weighting   = (1. - exp)
         
+        self.unit_cell_weighting = self.unit_cell_weighting.astype(dtype)
+        self.diffuse_weighting   = self.diffuse_weighting.astype(dtype)
+        
+        if self.rfft :
+            self.unit_cell_weighting = self.half.half(self.unit_cell_weighting)
+            self.diffuse_weighting   = self.half.half(self.diffuse_weighting)
+        
+        # the unit cell term is zero away from the reciprocal lattice
+        self.lattice_index, self.unit_cell_weighting_L = lattice_index(self.unit_cell_weighting)
+        
         self.modes = np.zeros( (2 * self.sym_ops.syms.shape[0],) + self.sym_ops.syms.shape[1:], O.dtype)
         # diffuse terms
-        self.modes[:self.modes.shape[0]//2] = self.sym_ops.solid_syms_Fourier(O, apply_translation = False)
+        self.sym_ops.solid_syms_Fourier(O, apply_translation = False, out = self.modes[:self.modes.shape[0]//2])
         # unit cell terms
-        self.modes[self.modes.shape[0]//2:] = self.sym_ops.solid_syms_Fourier(O, apply_translation = True)
+        self.sym_ops.solid_syms_Fourier(O, apply_translation = True, out = self.modes[self.modes.shape[0]//2:])
+        
+        # work space for the unflipped modes in Psup
+        self.modes_unflipped = np.empty_like(self.modes)
 
         print('eMod(modes0):', self.Emod(self.modes))
 
@@ -313,6 +567,12 @@ class Mapper_ellipse():
         # floating point tolerance for 1/x (log10)  
         tol = 100. #1.0e+100
         
+        # the (symmetrised) intensity on the stored voxels, the ellipse
+        # projection does not use the mask so (as for the full spectrum)
+        # the axes are also made where q and -q are both masked
+        if self.rfft :
+            I = np.where(self.mask_P, self.amp_P, 0.5 * (self.amp + self.amp_c))**2
+        
         # check for numbers close to infinity in sqrt(I / self.diffuse_weighting)
         m     = self.diffuse_weighting <= 0.0
         m[~m] = 0.5 * (np.log10(I[~m]) - np.log10(self.diffuse_weighting[~m])) > tol
@@ -328,57 +588,74 @@ class Mapper_ellipse():
         self.e1_inf = m.copy()
         self.e1     = np.zeros_like(self.unit_cell_weighting)
         self.e1[~m] = np.sqrt(I[~m]) / np.sqrt(self.sym_ops.syms.shape[0] * self.unit_cell_weighting[~m])
+        
+        # away from the reciprocal lattice e1_inf is True and the ellipse
+        # degenerates to x = e0 (x if e0_inf), so only the lattice voxels
+        # need the ellipse projection
+        L = self.lattice_index
+        self.e0_L, self.e1_L = [a.ravel()[L].astype(np.float64) for a in [self.e0, self.e1]]
+        self.e0_inf_L, self.e1_inf_L = [a.ravel()[L] for a in [self.e0_inf, self.e1_inf]]
+        self.e0_D = np.where(self.e0_inf, np.nan, self.e0)
 
         self.iters = 0
          
     def object(self, modes):
-        out = np.fft.ifftn(modes[0])
+        if self.rfft :
+            return self.fft.irfftn(modes[0], self.shape)
+        
+        out = self.fft.ifftn(modes[0])
         return out
 
     def Imap(self, modes):
 
-        U  = np.sum(modes[modes.shape[0]//2 :], axis=0)
         D  = modes[: modes.shape[0]//2]
         
         I  = self.diffuse_weighting   * np.sum( (D * D.conj()).real, axis=0)
-        I += self.unit_cell_weighting * (U * U.conj()).real
+        
+        # unit cell term on the lattice voxels only
+        U  = lattice_sum(modes[modes.shape[0]//2 :], self.lattice_index)
+        I.reshape(-1)[self.lattice_index] += self.unit_cell_weighting_L * (U * U.conj()).real
         return I
     
     def Psup(self, modes):
         #return modes.copy()
-        out = np.empty_like(modes)
+        out = self.modes_unflipped
         
         # diffuse terms: unflip the modes
-        out[: modes.shape[0]//2] = \
-                self.sym_ops.unflip_modes_Fourier(modes[: modes.shape[0]//2], apply_translation = False)
+        self.sym_ops.unflip_modes_Fourier(modes[: modes.shape[0]//2], apply_translation = False, \
+                                          out = out[: modes.shape[0]//2])
 
         # unit_cell terms: unflip the modes
-        out[modes.shape[0]//2 :] = \
-                self.sym_ops.unflip_modes_Fourier(modes[modes.shape[0]//2 :], apply_translation = True)
+        self.sym_ops.unflip_modes_Fourier(modes[modes.shape[0]//2 :], apply_translation = True, \
+                                          out = out[modes.shape[0]//2 :])
 
         # average 
         out = np.mean(out, axis=0)
         
         # propagate
-        out = np.fft.ifftn(out)
+        if self.rfft :
+            out = self.fft.irfftn(out, self.shape)
+        else :
+            out = self.fft.ifftn(out)
 
         # finite support
         if self.voxel_number :
-            self.S = choose_N_highest_pixels( (out * out.conj()).real, self.voxel_number, \
+            self.S = self.n_highest_pixels( (out * out.conj()).real, self.voxel_number, \
                     support = self.support, mapper = self.sym_ops.solid_syms_real)
 
         out *= self.S
 
-        # reality
-        out.imag = 0
-
-        # propagate
-        out = np.fft.fftn(out)
+        # reality and propagate
+        if self.rfft :
+            out = self.fft.rfftn(out)
+        else :
+            out.imag = 0
+            out = self.fft.fftn(out)
 
         # broadcast
         modes_out = np.empty_like(self.modes)
-        modes_out[: modes_out.shape[0]//2] = self.sym_ops.solid_syms_Fourier(out, apply_translation=False)
-        modes_out[modes_out.shape[0]//2 :] = self.sym_ops.solid_syms_Fourier(out, apply_translation=True)
+        self.sym_ops.solid_syms_Fourier(out, apply_translation=False, out = modes_out[: modes_out.shape[0]//2])
+        self.sym_ops.solid_syms_Fourier(out, apply_translation=True,  out = modes_out[modes_out.shape[0]//2 :])
 
         self.iters += 1
         
@@ -393,42 +670,36 @@ class Mapper_ellipse():
 
         U  = modes[modes.shape[0]//2 :]
         D  = modes[: modes.shape[0]//2]
+        L  = self.lattice_index
 
         # make x
         #-----------------------------------------------
         x = np.sqrt(np.sum( (D * D.conj()).real, axis=0))
         
-        # make y
+        # make y (on the lattice voxels)
         #-----------------------------------------------
-        # rotate the unit cell modes
-        # eg. for N = 2 : Ut = np.array([[1., 1.], [-1., 1.]], dtype=np.float64) / np.sqrt(2.)
-
-        Ut = make_unitary_transform(modes.shape[0]//2)
-
-        u = np.dot(Ut, U.reshape((U.shape[0], -1)))
+        # rotate the unit cell modes, u = Ut . U (see make_unitary_transform)
+        # where only u[0] = sum_n U_n / sqrt(N) is needed
+        Us = lattice_sum(U, L)
         
-        y = np.abs(np.sum(U, axis=0) / np.sqrt(U.shape[0]))
+        y = np.abs(Us) / np.sqrt(U.shape[0])
         
-        tol = 1.0e-10
         # project onto xp yp
         #-----------------------------------------------
-        #assert np.all(self.e0[~self.e0_inf] > 0)
-        #assert np.all(self.e1[~self.e1_inf] > 0)
-        xp = np.empty_like(x)
-        yp = np.empty_like(x)
-        it = np.nditer([self.e0, self.e1, x, y, self.e0_inf, self.e1_inf, xp, yp],
-                        op_flags = [['readonly'], ['readonly'], ['readonly'], ['readonly'],
-                                    ['readonly'],['readonly'],['writeonly', 'no_broadcast'],
-                                    ['writeonly', 'no_broadcast']])
-        for e0, e1, xi, yi, e0_inf, e1_inf, uu, vv in it:
-            uu[...], vv[...] = project_2D_Ellipse_cython(e0, e1, xi, yi, e0_inf, e1_inf)
-
-            # check
-            #if (not e0_inf) and (not e1_inf) :
-            #    err = abs((uu[...] / e0)**2 + (vv[...] / e1)**2 - 1.)
-            #    if err > tol :
-            #        print('e0, e1, xi, yi, xp, yp, err:', e0, e1, xi, yi, uu[...], vv[...], err)
+        # diffuse only voxels: xp = e0 (or x if e0_inf), yp = y
+        xp = np.where(self.e0_inf, x, self.e0_D)
+        
+        # lattice voxels
+        x_L  = x.ravel()[L]
+        xp_L = np.empty(x_L.shape, dtype=np.float64)
+        yp   = np.empty(y.shape, dtype=np.float64)
+        project_2D_Ellipse_arrays(self.e0_L, self.e1_L, x_L, y, self.e0_inf_L, self.e1_inf_L, xp_L, yp)
+        xp.ravel()[L] = xp_L
 
+        # check
+        #m   = ~self.e0_inf_L * ~self.e1_inf_L
+        #err = np.abs((xp_L[m] / self.e0_L[m])**2 + (yp[m] / self.e1_L[m])**2 - 1.)
+        #print('max ellipse error:', err.max())
         
         # xp yp --> modes
         #-----------------------------------------------
@@ -437,10 +708,12 @@ class Mapper_ellipse():
         out[: modes.shape[0]//2] *= rx
         
         ry = yp / (y + self.alpha)
-        u[0] *= ry.ravel()
         
-        # un rotate the y's
-        out[modes.shape[0]//2 :] = np.dot(Ut.T, u).reshape(U.shape)
+        # un rotate the y's: u[0] *= ry then Ut^T . u, since the first 
+        # row of Ut is 1 / sqrt(N) this is a correction by the mean mode
+        # U_n + (ry - 1) sum_n U_n / N (on the lattice voxels)
+        Us *= (ry - 1.) / U.shape[0]
+        out[modes.shape[0]//2 :].reshape((U.shape[0], -1))[:, L] += Us
 
         # check
         #print(' sum | sqrt(I) - sqrt(Imap) | : ', self.Emod(out))
@@ -449,7 +722,8 @@ class Mapper_ellipse():
     
     def Emod(self, modes):
         M         = self.Imap(modes)
-        eMod      = np.sum( self.mask * ( np.sqrt(M) - self.amp )**2 )
+        # the -q voxels that are not stored are included in rfft mode
+        eMod      = emod_cython(M.ravel(), *self.mod_data[2:])
         eMod      = np.sqrt( eMod / self.I_norm )
         return eMod
 
@@ -457,20 +731,32 @@ class Mapper_ellipse():
         out = {}
         out['support'] = self.S
         out['I']       = self.Imap(modes)
+        if self.rfft :
+            out['I'] = self.half.full(out['I'])
         return out
 
     def l2norm(self, delta, array0):
         num = 0
         den = 0
+        if self.rfft :
+            sum = self.half.sum
+        else :
+            sum = lambda a : np.sum(a, dtype=np.float64)
         for i in range(delta.shape[0]):
-            num += np.sum( (delta[0] * delta[0].conj()).real ) 
-            den += np.sum( (array0[0] * array0[0].conj()).real ) 
+            num += sum( (delta[0] * delta[0].conj()).real ) 
+            den += sum( (array0[0] * array0[0].conj()).real ) 
         return np.sqrt(num / den)
 
-    def scans_cheshire(self, solid):
+    def scans_cheshire(self, solid, processes = None):
         """
         scan the solid unit through the cheshire cell 
         until the best agreement with the data is found.
+
+        Every voxel shift (i, j, k) in the cheshire cell is
+        evaluated (see cheshire_errors) with a pool of 'processes' 
+        workers (None for all cores, the scan is serial when called 
+        from a daemonic process). The full error map is returned 
+        in info['errors'].
         """
         
         s = phasing_3d.utils.merge.centre(solid)
@@ -479,24 +765,18 @@ class Mapper_ellipse():
         J //= 2
         K //= 2
         modes = np.empty_like(self.modes)
-        step = 4
-        errors = np.zeros((I, J, K), dtype=np.float)
-        errors.fill(np.inf)
-        for i in range(0, I, step):
-            for j in range(0, J, step):
-                for k in range(0, K, step):
-                    # shift
-                    s1 = phasing_3d.utils.merge.multiroll(s, [i,j,k])
-                    
-                    # propagate
-                    s1 = np.fft.fftn(s1)
-                    
-                    # broadcast
-                    modes[: modes.shape[0]//2] = self.sym_ops.solid_syms_Fourier(s1, apply_translation=False)
-                    modes[modes.shape[0]//2 :] = self.sym_ops.solid_syms_Fourier(s1, apply_translation=True)
-                    
-                    errors[i, j, k] = self.Emod(modes)
-                    print(i, j, k, errors[i,j,k])
+        
+        # propagate once, the shifts are phase ramps
+        if self.rfft :
+            s1 = self.fft.rfftn(s)
+        else :
+            s1 = self.fft.fftn(s)
+        
+        # broadcast
+        self.sym_ops.solid_syms_Fourier(s1, apply_translation=False, out = modes[: modes.shape[0]//2])
+        self.sym_ops.solid_syms_Fourier(s1, apply_translation=True,  out = modes[modes.shape[0]//2 :])
+        
+        errors = cheshire_errors(self, modes, (I, J, K), processes)
         
         l = np.argmin(errors)
         i, j, k = np.unravel_index(l, errors.shape)
@@ -506,22 +786,162 @@ class Mapper_ellipse():
         s1 = phasing_3d.utils.merge.multiroll(s, [i,j,k])
         
         # propagate
-        s1 = np.fft.fftn(s1)
+        if self.rfft :
+            s1 = self.fft.rfftn(s1)
+        else :
+            s1 = self.fft.fftn(s1)
         
         # broadcast
-        modes[: modes.shape[0]//2] = self.sym_ops.solid_syms_Fourier(s1, apply_translation=False)
-        modes[modes.shape[0]//2 :] = self.sym_ops.solid_syms_Fourier(s1, apply_translation=True)
+        self.sym_ops.solid_syms_Fourier(s1, apply_translation=False, out = modes[: modes.shape[0]//2])
+        self.sym_ops.solid_syms_Fourier(s1, apply_translation=True,  out = modes[modes.shape[0]//2 :])
         
         s1 = phasing_3d.utils.merge.multiroll(s, [i,j,k])
         
         info = {}
         info['eMod'] = [errors[i, j, k]]
+        info['errors'] = errors
         info['eCon'] = [self.l2norm(self.modes - modes, modes)]
         info.update(self.finish(modes))
         return s1, info
 
 
 
+def cheshire_errors(mapper, modes, shape, processes = None):
+    """
+    Return eMod (see Mapper_ellipse.Emod) for every shift t = (i, j, k) 
+    of the solid unit, with 0 <= i < shape[0] etc., as an array of this shape.
+
+    modes are the (diffuse and unit cell) modes of the unshifted solid unit.
+    Shifting the solid unit by t multiplies the n'th mode by:
+        exp(-2 pi i (R_n^T . q) . t / N)
+    
+    where R_n is the rotation of the n'th symmetry operator and N the
+    detector shape. This leaves the diffuse term of Imap unchanged, so 
+    the error away from the reciprocal lattice is calculated once and 
+    only the lattice voxels are evaluated for each shift. The phase 
+    ramps are separable and are looked up from per axis tables, each
+    plane of constant i is a task for a multiprocessing pool.
+    """
+    M = modes.shape[0] // 2
+    
+    # shift invariant diffuse term
+    D = mapper.diffuse_weighting * np.sum( (modes[:M] * modes[:M].conj()).real, axis=0)
+    
+    # error of each voxel without the unit cell term
+    e = mapper.mask * (np.sqrt(D) - mapper.amp)**2
+    if mapper.rfft :
+        e += mapper.mask_c * (np.sqrt(D) - mapper.amp_c)**2
+    
+    index = mapper.lattice_index
+    e_off = np.sum(e) - np.sum(e.ravel()[index])
+    
+    # the lattice voxels that contribute to eMod (mask may be a scalar)
+    mask   = np.broadcast_to(mapper.mask, mapper.amp.shape).ravel()[index].astype(np.float64)
+    amp    = mapper.amp.ravel()[index]
+    if mapper.rfft :
+        mask_c = mapper.mask_c.ravel()[index].astype(np.float64)
+        amp_c  = mapper.amp_c.ravel()[index]
+    else :
+        mask_c = np.zeros_like(mask)
+        amp_c  = np.zeros_like(amp)
+    
+    keep  = (mask > 0) | (mask_c > 0)
+    index = index[keep]
+    
+    # the unit cell modes on the lattice voxels
+    B = np.ascontiguousarray(modes[M:]).reshape((M, -1))[:, index]
+    
+    # Fourier space coordinates (np.fft.fftfreq basis) of the lattice 
+    # voxels and of the rotated voxels R_n^T . q for each mode
+    det = mapper.shape
+    q   = np.array(np.unravel_index(index, D.shape))
+    q   = np.array([np.fft.fftfreq(det[a], 1./det[a]).astype(int)[q[a]] for a in range(3)])
+    Rq  = np.array([np.dot(op['R'].T, q) % np.array(det)[:, None] for op in mapper.sym_ops.ops])
+    
+    # phase ramp tables exp(-2 pi i q t / N) for each axis
+    ramps = [np.exp(-2J * np.pi * np.outer(np.arange(det[a]), np.arange(shape[a])) / float(det[a])) \
+             for a in range(3)]
+    
+    c = {'B' : B, 'Rq' : Rq, 'ramps' : ramps, 'shape' : shape, 
+         'D' : D.ravel()[index], 'w' : mapper.unit_cell_weighting_L[keep], 
+         'mask' : mask[keep], 'amp' : amp[keep], 'mask_c' : mask_c[keep], 'amp_c' : amp_c[keep]}
+    
+    if processes is None :
+        processes = multiprocessing.cpu_count()
+    
+    # a daemonic process (e.g. a phasing repeat in a pool) cannot have children
+    if multiprocessing.current_process().daemon :
+        processes = 1
+    
+    if processes == 1 or shape[0] == 1 :
+        _cheshire_init(c)
+        planes = [_cheshire_plane(i) for i in range(shape[0])]
+    else :
+        pool   = multiprocessing.Pool(processes, _cheshire_init, (c,))
+        planes = pool.map(_cheshire_plane, range(shape[0]))
+        pool.close()
+        pool.join()
+    
+    errors = np.sqrt( (e_off + np.array(planes)) / mapper.I_norm )
+    return errors
+
+# the lattice data for the cheshire scan (set in each worker)
+_cheshire = {}
+
+def _cheshire_init(c):
+    _cheshire.clear()
+    _cheshire.update(c)
+
+def _cheshire_plane(i):
+    """
+    The lattice voxel error for the shifts (i, :, :), see cheshire_errors.
+    """
+    c     = _cheshire
+    J, K  = c['shape'][1:]
+    Rq    = c['Rq']
+    r0, r1, r2 = c['ramps']
+    L     = c['B'].shape[1]
+    
+    # limit the work space to ~ 2**20 voxels
+    chunk = max(1, 2**20 // (J * K))
+    
+    err = np.zeros((J, K), dtype=np.float64)
+    for l0 in range(0, L, chunk):
+        l = slice(l0, min(L, l0 + chunk))
+        
+        # U = sum_n B_n exp(-2 pi i (R_n^T . q) . t / N)
+        U = 0
+        for n in range(c['B'].shape[0]):
+            b  = c['B'][n, l] * r0[Rq[n, 0, l], i]
+            U  = U + (b[:, None] * r1[Rq[n, 1, l]])[:, :, None] * r2[Rq[n, 2, l]][:, None, :]
+        
+        M   = np.sqrt( c['D'][l, None, None] + c['w'][l, None, None] * (U * U.conj()).real )
+        err += np.sum( c['mask'][l, None, None] * (M - c['amp'][l, None, None])**2, axis=0 )
+        err += np.sum( c['mask_c'][l, None, None] * (M - c['amp_c'][l, None, None])**2, axis=0 )
+    return err
+
+
+def project_2D_Ellipse_arrays(e0, e1, x, y, e0_inf, e1_inf, u, v):
+    """
+    Project every (x, y) pair onto the ellipse (u/e0)**2 + (v/e1)**2 = 1 
+    with a single call to the compiled kernel (see project_2D_Ellipse_cython).
+
+    e0, e1, x, y must be float64 arrays of the same shape, e0_inf and 
+    e1_inf are the boolean masks where the inverse axes lengths vanish.
+    u and v are contiguous float64 arrays (same shape) that receive the 
+    result.
+    """
+    project_2D_Ellipse_arrays_cython(
+            np.ascontiguousarray(e0, dtype=np.float64).ravel(), 
+            np.ascontiguousarray(e1, dtype=np.float64).ravel(), 
+            np.ascontiguousarray(x, dtype=np.float64).ravel(), 
+            np.ascontiguousarray(y, dtype=np.float64).ravel(), 
+            np.ascontiguousarray(e0_inf, dtype=np.bool).view(np.uint8).ravel(), 
+            np.ascontiguousarray(e1_inf, dtype=np.bool).view(np.uint8).ravel(), 
+            u.reshape(-1), v.reshape(-1))
+    return u, v
+
+
 def make_unitary_transform(N):
     U = np.zeros((N, N), dtype=np.float)
     U[0, :] = 1  / np.sqrt(N)
@@ -538,52 +958,103 @@ def make_unitary_transform(N):
     return U
 
 
-def choose_N_highest_pixels(array, N, tol = 1.0e-5, maxIters=1000, mapper = None, support = None):
+class N_highest_pixels():
     """
-    Use bisection to find the root of
-    e(x) = \sum_i (array_i > x) - N
-
-    then return (array_i > x) a boolean mask
+    Select the N highest pixels of an array (e.g. for the voxel_number 
+    support) as a boolean mask: (array_i > x) where x is the (N+1)'th 
+    highest value.
 
-    This is faster than using percentile (surprising)
+    The threshold x is kept between calls, since it barely changes from
+    one iteration to the next the old threshold is tried first (one pass
+    over the array). If it no longer selects N pixels then only the 
+    pixels between the old and the new threshold are partitioned (np.partition, 
+    O(n)) to find x exactly. The mask and work arrays are allocated once.
 
-    If support is not None then values outside the support
-    are ignored. 
+    If support is not None then values outside the support are ignored.
     """
+    def __init__(self, shape):
+        self.S         = np.zeros(shape, dtype=np.bool)
+        self.work      = np.empty((int(np.prod(shape)),), dtype=np.float64)
+        self.candidate = np.zeros(shape, dtype=np.bool)
+        self.threshold = None
+
+    def __call__(self, array, N, mapper = None, support = None):
+        # no overlap constraint
+        if mapper is not None :
+            syms = mapper(array)
+            # if array is not the maximum value
+            # of the M symmetry related units 
+            # then do not update 
+            support = syms[0] == np.max(syms, axis=0) 
+        
+        S = self.S
+        if support is None :
+            n = array.size
+        else :
+            n = np.count_nonzero(support)
+        
+        # there are not enough pixels
+        if N >= n :
+            self.threshold = None
+            if support is None :
+                S.fill(True)
+            else :
+                S[...] = support > 0
+            return S
+        
+        # warm start from the last threshold
+        if self.threshold is not None :
+            self._mask(array, self.threshold, support)
+            c = np.count_nonzero(S)
+            if c == N :
+                return S
+            
+            # candidates for the new threshold
+            #   c > N : those above the old threshold
+            #   c < N : those within the support below the old threshold
+            if c > N :
+                np.copyto(self.candidate, S)
+                k = c - N - 1
+            else :
+                np.logical_not(S, out = self.candidate)
+                if support is not None :
+                    self.candidate &= support > 0
+                k = (n - c) - (N + 1 - c)
+        
+        else :
+            if support is None :
+                self.candidate.fill(True)
+            else :
+                self.candidate[...] = support > 0
+            k = n - N - 1
+        
+        if self.work.dtype != array.dtype :
+            self.work = np.empty(self.work.shape, dtype=array.dtype)
+        
+        m = np.count_nonzero(self.candidate)
+        a = self.work[: m]
+        np.compress(self.candidate.ravel(), array.ravel(), out = a)
+        a.partition(k)
+        self.threshold = a[k]
+        
+        self._mask(array, self.threshold, support)
+        # print('number of pixels in support:', np.sum(S), self.threshold)
+        return S
 
-    # no overlap constraint
-    if mapper is not None :
-        syms = mapper(array)
-        # if array is not the maximum value
-        # of the M symmetry related units 
-        # then do not update 
-        support = syms[0] == np.max(syms, axis=0) 
-        a = array[support]
-    else :
-        support = np.ones(array.shape, dtype = np.bool)
-        a = array
+    def _mask(self, array, threshold, support):
+        np.greater(array, threshold, out = self.S)
+        if support is not None :
+            self.S &= support > 0
 
-    if support is not None :
-        a = array[support > 0]
-    else :
-        a = array
-        support = 1
-    
-    s0 = array.max()
-    s1 = array.min()
-    
-    for i in range(maxIters):
-        s = (s0 + s1) / 2.
-        e = np.sum(a > s) - N
-    
-        if np.abs(e) < tol :
-            break
 
-        if e < 0 :
-            s0 = s
-        else :
-            s1 = s
-        
-    S = (array > s) * support
-    # print('number of pixels in support:', np.sum(S), i, s, e)
-    return S
+def choose_N_highest_pixels(array, N, tol = 1.0e-5, maxIters=1000, mapper = None, support = None):
+    """
+    return (array_i > x) a boolean mask with N pixels
+
+    see N_highest_pixels, tol and maxIters are ignored 
+    (they were used by the old bisection search).
+
+    If support is not None then values outside the support
+    are ignored. 
+    """
+    return N_highest_pixels(array.shape)(array, N, mapper, support).copy()
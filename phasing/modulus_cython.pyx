@@ -0,0 +1,90 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+
+cimport cython
+from libc.math cimport sqrt
+
+# single or double precision (the error is accumulated in double precision)
+ctypedef fused real_t:
+    float
+    double
+
+ctypedef fused complex_t:
+    float complex
+    double complex
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def pmod_emod_cython(const complex_t[::1] O, const real_t[::1] I,
+                     const real_t[::1] amp_P, const real_t[::1] mask_P,
+                     const real_t[::1] amp, const real_t[::1] mask,
+                     const real_t[::1] amp_c, const real_t[::1] mask_c,
+                     double alpha, complex_t[::1] out):
+    """
+    Apply the modulus constraint to O given the intensity model I
+    and accumulate the (masked) modulus error of I, in one pass
+    over the (flat, contiguous) arrays:
+        out  = mask_P * O * amp_P / sqrt(I + alpha) + (1 - mask_P) * O
+        err  = sum mask   * (sqrt(I) - amp)**2
+             + sum mask_c * (sqrt(I) - amp_c)**2
+
+    amp_c and mask_c are the data of the voxels that are not stored
+    in rfft mode, pass empty arrays otherwise.
+
+    Returns err (not normalised).
+    """
+    cdef Py_ssize_t n, N = I.shape[0]
+    cdef bint conj = amp_c.shape[0] > 0
+    cdef double M, e, err = 0
+    cdef real_t r
+
+    if not (O.shape[0] == amp_P.shape[0] == mask_P.shape[0] == out.shape[0] == \
+            amp.shape[0] == mask.shape[0] == N):
+        raise ValueError('all arrays must have the same length')
+
+    if conj and not (amp_c.shape[0] == mask_c.shape[0] == N):
+        raise ValueError('all arrays must have the same length')
+
+    with nogil:
+        for n in range(N):
+            M    = sqrt(I[n])
+            e    = M - amp[n]
+            err += mask[n] * e * e
+            if conj :
+                e    = M - amp_c[n]
+                err += mask_c[n] * e * e
+
+            r      = <real_t> (mask_P[n] * amp_P[n] / sqrt(I[n] + alpha) + (1. - mask_P[n]))
+            out[n] = O[n] * r
+    return err
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def emod_cython(const real_t[::1] I, const real_t[::1] amp, const real_t[::1] mask,
+                const real_t[::1] amp_c, const real_t[::1] mask_c):
+    """
+    The masked modulus error of the intensity model I (not 
+    normalised), see pmod_emod_cython.
+    """
+    cdef Py_ssize_t n, N = I.shape[0]
+    cdef bint conj = amp_c.shape[0] > 0
+    cdef double M, e, err = 0
+
+    if not (amp.shape[0] == mask.shape[0] == N):
+        raise ValueError('all arrays must have the same length')
+
+    if conj and not (amp_c.shape[0] == mask_c.shape[0] == N):
+        raise ValueError('all arrays must have the same length')
+
+    with nogil:
+        for n in range(N):
+            M    = sqrt(I[n])
+            e    = M - amp[n]
+            err += mask[n] * e * e
+            if conj :
+                e    = M - amp_c[n]
+                err += mask_c[n] * e * e
+    return err
@@ -44,6 +44,11 @@ def phase(I, solid_support, params, good_pix = None, solid_known = None):
 
     print 'background:', background, params['phasing']['background']
     
+    # numerical precision: 'single' or 'double' (see maps.get_dtypes)
+    dtype = 'double'
+    if 'phasing_parameters' in params.keys() and 'dtype' in params['phasing_parameters'].keys() :
+        dtype = params['phasing_parameters']['dtype']
+    
     d0 = time.time()
     
     alg_iters = config_iters_to_alg_num(params['phasing']['iters'])
@@ -58,7 +63,7 @@ def phase(I, solid_support, params, good_pix = None, solid_known = None):
             solid_ret, info = ERA(I, iters, support, params, \
                                   mask = good_pix, O = solid_ret, \
                                   background = background, method = 1, hardware = params['phasing']['hardware'], \
-                                  alpha = 1.0e-10, dtype = 'double', full_output = True)
+                                  alpha = 1.0e-10, dtype = dtype, full_output = True)
                     
             eMod += info['eMod']
             if 'background' in info.keys():
@@ -70,7 +75,7 @@ def phase(I, solid_support, params, good_pix = None, solid_known = None):
             solid_ret, info = DM(I, iters, support, params, \
                                   mask = good_pix, O = solid_ret, \
                                   background = background, method = 1, hardware = params['phasing']['hardware'], \
-                                  alpha = 1.0e-10, dtype = 'double', full_output = True)
+                                  alpha = 1.0e-10, dtype = dtype, full_output = True)
 
             eMod += info['eMod']
             if 'background' in info.keys():
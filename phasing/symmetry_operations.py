@@ -4,58 +4,60 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import numpy as np
+import os
 from itertools import product
 
 
-class P1():
-    """
-    Store arrays to make the crystal mapping more
-    efficient.
-
-    Assume that Fourier space arrays are fft shifted.
+# Symmetry operators of each space group, x' = R . x + T, in fractional
+# coordinates of the unit cell (orthogonal axes, International Tables
+# settings). Only signed permutation matrices are supported for R.
+I3 = np.identity(3, dtype=int)
 
-    Perform symmetry operations with the np.fft.fftfreq basis
-    so that (say) a flip operation behaves like:
-    a         = [0, 1, 2, 3, 4, 5, 6, 7]
-    a flipped = [0, 7, 6, 5, 4, 3, 2, 1]
-
-    or:
-    i         = np.fft.fftfreq(8)*8
-              = [ 0,  1,  2,  3, -4, -3, -2, -1]
-    i flipped = [ 0, -1, -2, -3, -4,  3,  2,  1]
-    """
-    def __init__(self, unitcell_size, det_shape, dtype=np.complex128):
-        # store the tranlation ramps
-        # x = x
-        T0 = 1
-        
-        self.translations = np.array([T0])
-        
-        # keep an array for the 1 symmetry related coppies of the solid unit
-        self.syms = np.zeros((1,) + tuple(det_shape), dtype=dtype)
+space_groups = {
+    'P1'      : [(I3,                        [0., 0., 0.])],
     
-    def solid_syms_Fourier(self, solid, apply_translation = True):
-        """
-        Take the Fourier space solid unit then return each
-        of the symmetry related partners.
-        """
-        # x = x
-        self.syms[0] = solid
-        
-        self.syms *= self.translations
-        return self.syms
-
-    def solid_syms_real(self, solid):
-        # x = x
-        self.syms[0] = solid
-        return self.syms
+    'P-1'     : [(I3,                        [0., 0., 0.]),   # x, y, z
+                 (-I3,                       [0., 0., 0.])],  # -x, -y, -z
+    
+    'P2'      : [(I3,                        [0., 0., 0.]),   # x, y, z
+                 (np.diag([-1, 1,-1]),       [0., 0., 0.])],  # -x, y, -z
+    
+    'P21'     : [(I3,                        [0., 0., 0.]),   # x, y, z
+                 (np.diag([-1, 1,-1]),       [0., 0.5, 0.])], # -x, 1/2 + y, -z
+    
+    'P222'    : [(I3,                        [0., 0., 0.]),   # x, y, z
+                 (np.diag([-1,-1, 1]),       [0., 0., 0.]),   # -x, -y, z
+                 (np.diag([-1, 1,-1]),       [0., 0., 0.]),   # -x, y, -z
+                 (np.diag([ 1,-1,-1]),       [0., 0., 0.])],  # x, -y, -z
+    
+    'P2221'   : [(I3,                        [0., 0., 0.]),   # x, y, z
+                 (np.diag([-1,-1, 1]),       [0., 0., 0.5]),  # -x, -y, 1/2 + z
+                 (np.diag([-1, 1,-1]),       [0., 0., 0.5]),  # -x, y, 1/2 - z
+                 (np.diag([ 1,-1,-1]),       [0., 0., 0.])],  # x, -y, -z
+    
+    'P21212'  : [(I3,                        [0., 0., 0.]),   # x, y, z
+                 (np.diag([-1,-1, 1]),       [0., 0., 0.]),   # -x, -y, z
+                 (np.diag([-1, 1,-1]),       [0.5, 0.5, 0.]), # 1/2 - x, 1/2 + y, -z
+                 (np.diag([ 1,-1,-1]),       [0.5, 0.5, 0.])],# 1/2 + x, 1/2 - y, -z
+    
+    'P212121' : [(I3,                        [0., 0., 0.]),   # x, y, z
+                 (np.diag([ 1,-1,-1]),       [0.5, 0.5, 0.]), # 1/2 + x, 1/2 - y, -z
+                 (np.diag([-1, 1,-1]),       [0., 0.5, 0.5]), # -x, 1/2 + y, 1/2 - z
+                 (np.diag([-1,-1, 1]),       [0.5, 0., 0.5])],# 1/2 - x, -y, 1/2 + z
+    
+    'P4'      : [(I3,                        [0., 0., 0.]),   # x, y, z
+                 (np.diag([-1,-1, 1]),       [0., 0., 0.]),   # -x, -y, z
+                 ([[0,-1, 0],[1, 0, 0],[0, 0, 1]], [0., 0., 0.]),   # -y, x, z
+                 ([[0, 1, 0],[-1, 0, 0],[0, 0, 1]], [0., 0., 0.])], # y, -x, z
+    
+    'P41'     : [(I3,                        [0., 0., 0.]),   # x, y, z
+                 (np.diag([-1,-1, 1]),       [0., 0., 0.5]),  # -x, -y, 1/2 + z
+                 ([[0,-1, 0],[1, 0, 0],[0, 0, 1]], [0., 0., 0.25]),  # -y, x, 1/4 + z
+                 ([[0, 1, 0],[-1, 0, 0],[0, 0, 1]], [0., 0., 0.75])],# y, -x, 3/4 + z
+    }
 
-    def unflip_modes_Fourier(self, U, apply_translation = True):
-        out = np.empty_like(U)
-        out[0] = U[0]
-        return out
 
-class P212121():
+class Space_group():
     """
     Store arrays to make the crystal mapping more
     efficient.
@@ -71,121 +73,292 @@ class P212121():
     i         = np.fft.fftfreq(8)*8
               = [ 0,  1,  2,  3, -4, -3, -2, -1]
     i flipped = [ 0, -1, -2, -3, -4,  3,  2,  1]
+
+    For the operator x' = R . x + T (see space_groups) the 
+    symmetry related copy of the solid unit is:
+        o'(r) = o(R^T . (r - T))       (real space)
+        O'(q) = O(R^T . q) e^{-2pi i q . T}  (Fourier space)
+
+    The operators are compiled once for the detector shape into
+    an axis transposition, blocks of strided views for the flips
+    (see flip_blocks) and factored phase ramps for the translations
+    (see T_fourier_factors), so every space group uses the same 
+    allocation free path when an output array is supplied.
+
+    If rfft is True then the solid unit is real and Fourier space arrays
+    only contain the non-negative frequencies of the last axis (np.fft.rfftn).
+    Flips of the last axis then become flips of the other two axes and a 
+    complex conjugation, since O(-q) = O*(q):
+        O(i, -j, -k) = O*(-i, j, k)
     """
-    def __init__(self, unitcell_size, det_shape, dtype=np.complex128):
-        # only calculate the translations when they are needed
-        self.translations = None
+    def __init__(self, space_group, unitcell_size, det_shape, dtype=np.complex128, rfft=False):
+        if space_group not in space_groups :
+            raise ValueError('unknown space group: ' + str(space_group) + \
+                             ' (choose from ' + str(sorted(space_groups.keys())) + ')')
         
+        self.space_group   = space_group
         self.unitcell_size = unitcell_size
         self.det_shape     = det_shape
+        self.rfft          = rfft
         
-        # keep an array for the 4 symmetry related coppies of the solid unit
-        self.syms = np.zeros((4,) + tuple(det_shape), dtype=dtype)
+        # only calculate the translations when they are needed
+        self.translations     = None
+        self.translations_inv = None
+        
+        # compile the operators
+        self.ops = compile_ops(space_group, det_shape, rfft)
+        
+        # keep an array for the symmetry related coppies of the solid unit
+        self.syms = np.zeros((len(self.ops),) + Fourier_shape(det_shape, rfft), dtype=dtype)
 
     def make_Ts(self):
-        det_shape     = self.det_shape
-        unitcell_size = self.unitcell_size
-        # store the tranlation ramps
-        # x = x
-        T0 = np.ones(det_shape, dtype=np.complex128)
-        # x = 0.5 + x, 0.5 - y, -z
-        T1 = T_fourier(det_shape, [unitcell_size[0]/2., unitcell_size[1]/2., 0.0])
-        # x = -x, 0.5 + y, 0.5 - z
-        T2 = T_fourier(det_shape, [0.0, unitcell_size[1]/2., unitcell_size[2]/2.])
-        # x = 0.5 - x, -y, 0.5 + z
-        T3 = T_fourier(det_shape, [unitcell_size[0]/2., 0.0, unitcell_size[2]/2.])
-        self.translations = np.array([T0, T1, T2, T3])
-    
-    def solid_syms_Fourier(self, solid, apply_translation = True):
-        self.syms = self.syms.astype(solid.dtype)
+        # store the tranlation ramps (as factors)
+        self.translations     = []
+        self.translations_inv = []
+        for op in self.ops :
+            T  = op['T'] * np.array(self.unitcell_size, dtype=float)
+            Ts = T_fourier_factors(self.det_shape, T, self.rfft)
+            
+            # in the precision of the symmetry buffers
+            Ts = [t.astype(self.syms.dtype if np.iscomplexobj(t) else self.syms.real.dtype) for t in Ts]
+            
+            # the translations for the unflipped modes : unflip(T*) 
+            self.translations.append(Ts)
+            self.translations_inv.append([gather(np.conj(t), op['inv']) for t in Ts])
+    
+    def solid_syms_Fourier(self, solid, apply_translation = True, out = None):
+        """
+        Take the Fourier space solid unit then return each
+        of the symmetry related partners. 
+
+        The result is written into out if given, otherwise
+        into an internal array (self.syms) that is overwritten
+        on the next call.
+        """
+        if out is None :
+            if self.syms.dtype != solid.dtype :
+                self.syms = np.empty(self.syms.shape, dtype=solid.dtype)
+            out = self.syms
         
-        # x = x
-        self.syms[0] = solid
+        if apply_translation and self.translations is None :
+            self.make_Ts()
         
-        # x = 0.5 + x, 0.5 - y, -z
-        self.syms[1][:, 0, :]  = solid[:, 0, :]
-        self.syms[1][:, 1:, :] = solid[:, -1:0:-1, :]
-        self.syms[1][:, :, 1:] = self.syms[1][:, :, -1:0:-1]
+        for n, op in enumerate(self.ops):
+            gather(solid, op['fwd'], out[n])
+            
+            if apply_translation :
+                for T in self.translations[n] :
+                    np.multiply(out[n], T, out = out[n])
+        return out
+
+    def unflip_modes_Fourier(self, U, apply_translation = True, out = None):
+        """
+        The inverse of solid_syms_Fourier for each of the 
+        symmetry related partners in U (U is not modified).
         
-        # x = -x, 0.5 + y, 0.5 - z
-        self.syms[2][0, :, :]  = solid[0, :, :]
-        self.syms[2][1:, :, :] = solid[-1:0:-1, :, :]
-        self.syms[2][:, :, 1:] = self.syms[2][:, :, -1:0:-1]
+        The result is written into out if given.
+        """
+        if out is None :
+            out = np.empty_like(U)
         
-        # x = 0.5 - x, -y, 0.5 + z
-        self.syms[3][0, :, :]  = solid[0, :, :]
-        self.syms[3][1:, :, :] = solid[-1:0:-1, :, :]
-        self.syms[3][:, 1:, :] = self.syms[3][:, -1:0:-1, :]
+        if apply_translation and self.translations is None :
+            self.make_Ts()
         
-        if apply_translation :
-            if self.translations is None :
-                self.make_Ts()
+        # unflip(U T*) = unflip(U) unflip(T*)
+        for n, op in enumerate(self.ops):
+            gather(U[n], op['inv'], out[n])
             
-            self.syms *= self.translations
-        return self.syms
+            if apply_translation :
+                for T in self.translations_inv[n] :
+                    np.multiply(out[n], T, out = out[n])
+        return out
+
+    def solid_syms_sum(self, a, out = None, work = None):
+        """
+        sum_n of the symmetry related partners of the Fourier space
+        array a without the translations (or conjugation). For example
+        with a = |O|^2 this is sum_n |solid_syms_Fourier(O)[n]|^2.
 
-    def unflip_modes_Fourier(self, U, apply_translation=True):
-        U_inv = U.copy()
+        The result is written into out if given, work is an array of 
+        the same shape used for each partner.
+        """
+        if out is None :
+            out = np.empty(a.shape, dtype=a.dtype)
+        if work is None :
+            work = np.empty(a.shape, dtype=a.dtype)
         
-        if apply_translation :
-            if self.translations is None :
-                self.make_Ts()
-            
-            U_inv *= self.translations.conj()
+        out.fill(0)
+        for op in self.ops:
+            g = dict(op['fwd'], conj = False)
+            out += gather(a, g, work)
+        return out
+
+    def solid_syms_index(self, index):
+        """
+        For the flat (Fourier space) voxel indices 'index' return the 
+        flat indices i, the conjugation flags c and the translation 
+        factors T such that:
+            solid_syms_Fourier(solid)[n].ravel()[index] = 
+                conj_{c[n]}(solid.ravel()[i[n]]) * T[n]
         
-        # x = x
-        U_inv[0] = U_inv[0]
+        where i and T have the shape (number of operators, len(index)).
+        """
+        if self.translations is None :
+            self.make_Ts()
         
-        # x = 0.5 + x, 0.5 - y, -z
-        U_inv[1][:, 0, :]  = U_inv[1][:, 0, :]
-        U_inv[1][:, 1:, :] = U_inv[1][:, -1:0:-1, :]
-        U_inv[1][:, :, 1:] = U_inv[1][:, :, -1:0:-1]
-
-        # x = -x, 0.5 + y, 0.5 - z
-        U_inv[2][0, :, :]  = U_inv[2][0, :, :]
-        U_inv[2][1:, :, :] = U_inv[2][-1:0:-1, :, :]
-        U_inv[2][:, :, 1:] = U_inv[2][:, :, -1:0:-1]
+        shape = self.syms.shape[1:]
+        i     = np.arange(self.syms[0].size).reshape(shape)
+        q     = np.unravel_index(index, shape)
         
-        # x = 0.5 - x, -y, 0.5 + z
-        U_inv[3][0, :, :]  = U_inv[3][0, :, :]
-        U_inv[3][1:, :, :] = U_inv[3][-1:0:-1, :, :]
-        U_inv[3][:, 1:, :] = U_inv[3][:, -1:0:-1, :]
-
-        return U_inv
+        I = np.empty((len(self.ops), len(index)), dtype=i.dtype)
+        T = np.ones((len(self.ops), len(index)), dtype=self.syms.dtype)
+        c = np.zeros((len(self.ops),), dtype=bool)
+        for n, op in enumerate(self.ops):
+            I[n] = gather(i, op['fwd']).ravel()[index]
+            c[n] = op['fwd']['conj']
+            
+            for t in self.translations[n] :
+                T[n] *= t[tuple([q[a] if t.shape[a] > 1 else 0 for a in range(len(shape))])]
+        return I, c, T
 
     def solid_syms_real(self, solid):
         """
         This uses pixel shifts (not phase ramps) for translation.
         Therefore sub-pixel shifts are ignored.
         """
-        syms = self.syms #np.empty((4,) + solid.shape, dtype=solid.dtype)
-        
-        # x = x
-        syms[0] = solid
+        syms = np.empty((len(self.ops),) + solid.shape, dtype=solid.dtype)
         
-        # x = 0.5 + x, 0.5 - y, -z
-        syms[1][:, 0, :]  = solid[:, 0, :]
-        syms[1][:, 1:, :] = solid[:, -1:0:-1, :]
-        syms[1][:, :, 1:] = syms[1][:, :, -1:0:-1]
-        
-        # x = -x, 0.5 + y, 0.5 - z
-        syms[2][0, :, :]  = solid[0, :, :]
-        syms[2][1:, :, :] = solid[-1:0:-1, :, :]
-        syms[2][:, :, 1:] = syms[2][:, :, -1:0:-1]
+        for n, op in enumerate(self.ops):
+            gather(solid, op['real'], syms[n])
+            
+            t = np.floor(op['T'] * np.array(self.unitcell_size)).astype(int)
+            if np.any(t != 0) :
+                syms[n] = multiroll(syms[n], t)
+        return syms
+
+
+def compile_ops(space_group, det_shape, rfft = False):
+    """
+    Compile the operators of space_group for the detector shape, returns
+    a list of dictionaries with the rotation 'R', the translation 'T' (in 
+    unit cells) and the compiled gathers (see compile_gather) for real 
+    space ('real') and for the forward ('fwd') and inverse ('inv') Fourier
+    space operations.
+    """
+    ops = []
+    for R, T in space_groups[space_group] :
+        R = np.array(R, dtype=int)
+        op = {}
+        op['R']   = R
+        op['T']   = np.array(T, dtype=float)
         
-        # x = 0.5 - x, -y, 0.5 + z
-        syms[3][0, :, :]  = solid[0, :, :]
-        syms[3][1:, :, :] = solid[-1:0:-1, :, :]
-        syms[3][:, 1:, :] = syms[3][:, -1:0:-1, :]
+        # O'(q) = O(R^T . q), real space
+        op['real'] = compile_gather(R.T, det_shape)
         
-        translations = []
-        translations.append([self.unitcell_size[0]//2, self.unitcell_size[1]//2, 0])
-        translations.append([0, self.unitcell_size[1]//2, self.unitcell_size[2]//2])
-        translations.append([self.unitcell_size[0]//2, 0, self.unitcell_size[2]//2])
+        # Fourier space forward and inverse
+        op['fwd'] = compile_gather(R.T, det_shape, rfft)
+        op['inv'] = compile_gather(R, det_shape, rfft)
+        ops.append(op)
+    return ops
+
+
+class P1(Space_group):
+    def __init__(self, unitcell_size, det_shape, dtype=np.complex128, rfft=False):
+        Space_group.__init__(self, 'P1', unitcell_size, det_shape, dtype, rfft)
+
+
+class P212121(Space_group):
+    """
+    see p212121diagramme.gif
+    """
+    def __init__(self, unitcell_size, det_shape, dtype=np.complex128, rfft=False):
+        Space_group.__init__(self, 'P212121', unitcell_size, det_shape, dtype, rfft)
+
+
+def compile_gather(P, shape, rfft = False):
+    """
+    Compile the gather out[i] = a[P . i] (np.fft.fftfreq basis), where P is 
+    a signed permutation matrix, into an axis transposition, the flipped
+    output axes and their flip blocks (see flip_blocks) and a complex 
+    conjugation flag (for rfft arrays, where flips of the last axis are 
+    replaced by O(i, j, -k) = O*(-i, -j, k)).
+    """
+    P = np.array(P, dtype=int)
+    if not np.all(np.abs(P) <= 1) or not np.all(np.sum(np.abs(P), axis=0) == 1) \
+                                  or not np.all(np.sum(np.abs(P), axis=1) == 1):
+        raise ValueError('only signed permutation matrices are supported, not: ' + str(P.tolist()))
+    
+    # (P . i)_a = s_a i_{p_a}
+    p = np.argmax(np.abs(P), axis=1)
+    s = P[np.arange(P.shape[0]), p]
+    
+    # a.transpose(axes)[i] = a[..., i_{p_a}, ...]
+    axes = tuple(np.argsort(p))
+    for a in range(len(shape)):
+        if shape[a] != shape[p[a]] :
+            raise ValueError('symmetry operator ' + str(P.tolist()) + ' swaps axes of unequal length: ' + str(shape))
+    
+    # then flip the output axes p_a where s_a = -1
+    flips = set([p[a] for a in range(len(s)) if s[a] == -1])
+    conj  = False
+    
+    if rfft :
+        last = len(shape) - 1
+        if axes[last] != last :
+            raise ValueError('symmetry operator ' + str(P.tolist()) + ' moves the last axis, this cannot be done with rfft')
         
-        for i, t in enumerate(translations):
-            syms[i+1] = multiroll(syms[i+1], t)
-        return syms.copy()
+        if last in flips :
+            flips = set(range(last)).symmetric_difference(flips - set([last]))
+            conj  = True
+    
+    flips = tuple(sorted(flips))
+    return {'axes' : axes, 'flips' : flips, 'blocks' : flip_blocks(flips, len(shape)), 'conj' : conj}
+
+def gather(a, g, out = None):
+    """
+    Apply the compiled gather g (see compile_gather) to a, the result is 
+    written into out if given. out and a must not overlap.
+    """
+    a = np.transpose(a, g['axes'])
+    if out is None :
+        out = np.empty(a.shape, dtype=a.dtype)
+    
+    flip_into(out, a, g['blocks'])
+    
+    if g['conj'] :
+        np.conjugate(out, out = out)
+    return out
+
+
+def flip_blocks(axes, ndim):
+    """
+    Return a list of (destination, source) slice tuples such that 
+    copying a[source] into b[destination] for every pair gives
+    b = a flipped along each of the 'axes' in the np.fft.fftfreq basis:
+        b[0] = a[0], b[1:] = a[-1:0:-1]
+    
+    These are strided views so no temporary arrays are made.
+    """
+    per_axis = []
+    for ax in range(ndim):
+        if ax in axes :
+            per_axis.append([(slice(0, 1), slice(0, 1)), (slice(1, None), slice(None, 0, -1))])
+        else :
+            per_axis.append([(slice(None), slice(None))])
+    
+    blocks = []
+    for b in product(*per_axis):
+        blocks.append((tuple([d for d, s in b]), tuple([s for d, s in b])))
+    return blocks
+
+def flip_into(out, a, blocks):
+    """
+    out = a flipped, where blocks is the output of flip_blocks. 
+    out and a must not overlap.
+    """
+    for dst, src in blocks :
+        np.copyto(out[dst], a[src])
+    return out
 
 
 def test_P212121():
@@ -248,6 +421,16 @@ def test_P212121():
     print('r3 = 1/2 - x, -y, 1/2 + z:', \
             np.allclose(unit_cell[i,j,k], unit_cell[i4,j4,k4]))
 
+def Fourier_shape(det_shape, rfft = False):
+    """
+    The shape of a Fourier space array on the detector, if rfft is True
+    then only the non-negative frequencies of the last axis are kept.
+    """
+    shape = tuple(det_shape)
+    if rfft :
+        shape = shape[:-1] + (shape[-1]//2 + 1,)
+    return shape
+
 def T_fourier(shape, T, is_fft_shifted = True):
     """
     e - 2pi i r q
@@ -269,6 +452,49 @@ def T_fourier(shape, T, is_fft_shifted = True):
     return phase_ramp
 
 
+def T_fourier_factors(shape, T, rfft = False):
+    """
+    The phase ramp of T_fourier as a product of 1D ramps:
+        e^{-2pi i q.T} = e^{-2pi i qi T0} e^{-2pi i qj T1} e^{-2pi i qk T2}
+    
+    Returns a list of arrays that broadcast against the Fourier space
+    volume (of shape Fourier_shape(shape, rfft)). Axes without a 
+    translation are dropped and pairs of ramps are combined into a 
+    plane, so at most two passes over the volume are needed. Ramps that
+    are real (e.g. +-1 for shifts of half the detector) are returned as
+    real arrays.
+    """
+    fshape = Fourier_shape(shape, rfft)
+    
+    ramps = []
+    for ax in range(len(shape)):
+        if T[ax] == 0 :
+            continue
+        
+        q    = np.fft.fftfreq(shape[ax])[: fshape[ax]]
+        ramp = np.exp(- 2J * np.pi * q * T[ax])
+        
+        # make +-1 and +-i exact
+        for part in [ramp.real, ramp.imag]:
+            m       = np.abs(part - np.round(part)) < 1.0e-12
+            part[m] = np.round(part[m])
+        
+        s      = [1 for n in shape]
+        s[ax]  = fshape[ax]
+        ramps.append(ramp.reshape(s))
+    
+    factors = []
+    while len(ramps) > 0 :
+        f = ramps.pop(0)
+        if len(ramps) > 0 :
+            f = f * ramps.pop(0)
+        
+        if np.all(f.imag == 0) :
+            f = f.real.copy()
+        factors.append(f)
+    return factors
+
+
 def solid_syms(solid_unit, unitcell_size, det_shape):
     """
     Take the solid unit and map it 
@@ -427,30 +653,57 @@ def multiroll(x, shift, axis=None):
 
     return y
 
-def lattice(unit_cell_size, shape):
+# lattices that have already been made, for each (unit_cell_size, shape)
+_lattices = {}
+
+def lattice_indices(unit_cell_size, shape):
+    """
+    For each axis return the detector pixel indices that are closest 
+    to the reciprocal lattice points (np.fft.fftfreq basis). 
+
+    The lattice is separable, lattice[i, j, k] = 1 for i in i_s, 
+    j in j_s and k in k_s, so only three 1D searches are needed.
+    """
+    out = []
+    for u, n in zip(unit_cell_size, shape):
+        q      = np.fft.fftfreq(n)
+        q_unit = np.fft.fftfreq(u)
+        # argmin picks the first of two equally close pixels
+        out.append(np.unique(np.argmin(np.abs(q_unit[:, np.newaxis] - q[np.newaxis, :]), axis=1)))
+    return out
+
+def lattice(unit_cell_size, shape, cache_dir = None):
     """
     We should just have delta functions at 1/d
     however, if the unit cell does not divide the 
     detector shape evenly then these fall between 
     pixels. 
+
+    The result is kept (read only) for each (unit_cell_size, shape)
+    so repeated calls are free. If cache_dir is not None then the 
+    lattice indices are also stored in / loaded from a file in that 
+    directory.
     """
-    # generate the q-space coordinates
-    qi = np.fft.fftfreq(shape[0])
-    qj = np.fft.fftfreq(shape[1])
-    qk = np.fft.fftfreq(shape[2])
+    key = (tuple([int(u) for u in unit_cell_size]), tuple([int(n) for n in shape]))
+    if key in _lattices :
+        return _lattices[key]
+
+    fnam = None
+    if cache_dir is not None :
+        fnam = os.path.join(cache_dir, 'lattice_' + '_'.join(['x'.join([str(n) for n in k]) for k in key]) + '.npz')
     
-    # generate the recirocal lattice points from the unit cell size
-    qs_unit = np.meshgrid(np.fft.fftfreq(unit_cell_size[0]), \
-                          np.fft.fftfreq(unit_cell_size[1]), \
-                          np.fft.fftfreq(unit_cell_size[2]), \
-                          indexing = 'ij')
+    if fnam is not None and os.path.exists(fnam):
+        f  = np.load(fnam)
+        ijk = [f['i'], f['j'], f['k']]
+    else :
+        ijk = lattice_indices(unit_cell_size, shape)
+        if fnam is not None :
+            np.savez(fnam, i = ijk[0], j = ijk[1], k = ijk[2])
     
     # now we want qs[qs_unit] = 1.
     lattice = np.zeros(shape, dtype=np.float)
-    for ii, jj, kk in zip(qs_unit[0].ravel(), qs_unit[1].ravel(), qs_unit[2].ravel()):
-        i = np.argmin(np.abs(ii - qi))
-        j = np.argmin(np.abs(jj - qj))
-        k = np.argmin(np.abs(kk - qk))
-        lattice[i, j, k] = 1.
+    lattice[np.ix_(*ijk)] = 1.
     
+    lattice.setflags(write = False)
+    _lattices[key] = lattice
     return lattice
@@ -3,6 +3,7 @@
 import ConfigParser
 import numpy as np
 import subprocess
+import copy
 
 import os, sys
 sys.path.append(os.path.abspath(__file__)[:-len(__file__)])
@@ -10,6 +11,62 @@ sys.path.append(os.path.abspath(__file__)[:-len(__file__)])
 import crappy_crystals
 import crappy_crystals.utils as utils
 
+def run(params, config_file):
+    """
+    Simulate the diffraction of the crystal (params['simulation']) then phase 
+    it with the main function of the phasing script params['phasing']['script']
+    (see examples/duck/phase.py) in this process, so the arrays are passed to 
+    it directly. input.h5 is written to the output path by another process 
+    while the phasing runs, unless params['output']['write_input'] is False. 
+
+    Phasing scripts without a main function are run as before with: 
+        python <script> input.h5
+    """
+    import imp
+    import multiprocessing
+    
+    script = imp.load_source('phasing_script', params['phasing']['script'])
+    in_process = hasattr(script, 'main')
+    
+    fnam   = os.path.join(params['output']['path'], 'input.h5')
+    kwargs = None
+    writer = None
+    
+    # forward problem
+    if params['simulation']['sample'] == 'duck':
+        diff, beamstop, edges, support, solid_unit, background = utils.generate_diff(params)
+        mask = beamstop * edges
+        
+        kwargs = {'data' : diff, 'sample_support' : support, 'good_pix' : mask, \
+                  'solid_unit' : solid_unit, 'background' : background}
+        
+        # write to file
+        h5args = dict(kwargs, config_file = config_file, **utils.io_utils.h5_options(params))
+        if not in_process :
+            utils.io_utils.write_input_output_h5(fnam, **h5args)
+        elif params['output'].get('write_input', True) :
+            writer = multiprocessing.Process(target = utils.io_utils.write_input_output_h5, \
+                                             args = (fnam,), kwargs = h5args)
+            writer.start()
+
+    # inverse problem
+    if in_process :
+        if kwargs is None :
+            # phase the existing input.h5
+            kwargs = utils.io_utils.read_input_output_h5(fnam)
+        else :
+            kwargs['config_file']      = copy.deepcopy(params)
+            kwargs['config_file_name'] = config_file
+        out = script.main(kwargs)
+        
+        if writer is not None :
+            writer.join()
+        return out
+    
+    runstr = "python " + params['phasing']['script'] + ' ' + fnam
+    print '\n',runstr
+    subprocess.call([runstr], shell=True)
+
 if __name__ == "__main__":
     args = utils.io_utils.parse_cmdline_args()
     
@@ -44,20 +101,4 @@ if __name__ == "__main__":
         subprocess.call([runstr], shell=True)
         sys.exit()
     
-    # forward problem
-    if params['simulation']['sample'] == 'duck':
-        diff, beamstop, edges, support, solid_unit, background = utils.generate_diff(params)
-        
-        # write to file
-        fnam = os.path.join(params['output']['path'], 'input.h5')
-        mask = beamstop * edges
-        utils.io_utils.write_input_output_h5(fnam, data = diff, sample_support = support, \
-                good_pix = mask, solid_unit = solid_unit, background = background,\
-                config_file = args.config)
-
-    # inverse problem
-    runstr = "python " + params['phasing']['script'] + ' ' + \
-                     os.path.join(params['output']['path'],'input.h5')
-    print '\n',runstr
-    subprocess.call([runstr], shell=True)
-
+    run(params, args.config)
@@ -1,24 +1,50 @@
 import numpy as np
 import os
 
+def nearest_indices(n, m):
+    """
+    The indices of the points of the regular grid 0, 1, ..., n-1 that are
+    nearest to the m evenly spaced points np.mgrid[0 : n-1 : m*1j]. 
+    """
+    return np.rint(np.mgrid[0 : n-1 : m*1j]).astype(np.int)
+
 def interp_3d(array, shapeout):
-    from scipy.interpolate import griddata
-    ijk = np.indices(array.shape)
-    
-    points = np.zeros((array.size, 3), dtype=np.float)
-    points[:, 0] = ijk[0].ravel()
-    points[:, 1] = ijk[1].ravel()
-    points[:, 2] = ijk[2].ravel()
-    values = array.astype(np.float).ravel()
+    """
+    Nearest neighbour resampling of array onto shapeout evenly spaced 
+    points along each axis (the grid is regular so the nearest point 
+    along each axis is the nearest point).
+    """
+    ijk = [nearest_indices(n, m) for n, m in zip(array.shape, shapeout)]
+    return array[np.ix_(*ijk)].astype(np.float)
+    
+# the ducks that have already been made, for each shape
+_ducks = {}
 
-    gridout  = np.mgrid[0: array.shape[0]-1: shapeout[0]*1j, \
-                        0: array.shape[1]-1: shapeout[1]*1j, \
-                        0: array.shape[2]-1: shapeout[2]*1j]
-    arrayout = griddata(points, values, (gridout[0], gridout[1], gridout[2]), method='nearest')
-    return arrayout
+def make_3D_duck(shape = (12, 25, 30), cache_dir = None):
+    """
+    A duck on a grid of the given shape. The duck is kept for each shape 
+    and if cache_dir is not None it is also stored in / loaded from 
+    'duck_3D_<shape>.npz' in that directory.
+    """
+    key = tuple([int(n) for n in shape])
+    if key in _ducks :
+        return _ducks[key].copy()
+    
+    fnam = None
+    if cache_dir is not None :
+        fnam = os.path.join(cache_dir, 'duck_3D_' + 'x'.join([str(n) for n in key]) + '.npz')
     
+    if fnam is not None and os.path.exists(fnam):
+        duck3d = np.load(fnam)['duck']
+    else :
+        duck3d = _make_3D_duck(key)
+        if fnam is not None :
+            np.savez(fnam, duck = duck3d)
+    
+    _ducks[key] = duck3d.astype(np.float)
+    return _ducks[key].copy()
 
-def make_3D_duck(shape = (12, 25, 30)):
+def _make_3D_duck(shape):
     script_dir = os.path.dirname(__file__)
     duck_fnam  = os.path.join(script_dir, 'duck_300_211_8bit.raw')
     
@@ -28,29 +54,19 @@ def make_3D_duck(shape = (12, 25, 30)):
     # convert to bool
     duck = duck < 50
 
-    # make a 3d volume
-    duck3d = np.zeros( (100,) + duck.shape , dtype=np.bool)
-
-    # loop over the third dimension with an expanding circle
-    i, j = np.mgrid[0 :duck.shape[0], 0 :duck.shape[1]]
-
+    # a 3d volume of shape (100,) + duck.shape, each z slice is the duck
+    # within an expanding then contracting circle. Only the voxels that
+    # are nearest to the output grid are made (see interp_3d).
+    z, i, j = [nearest_indices(n, m) for n, m in zip((100,) + duck.shape, shape)]
+    
     origin = [150, 150]
 
-    r = np.sqrt( ((i-origin[0])**2 + (j-origin[1])**2).astype(np.float) )
+    r = np.sqrt( ((i[:, np.newaxis]-origin[0])**2 + (j[np.newaxis, :]-origin[1])**2).astype(np.float) )
 
     rs = range(50) + range(50, 0, -1)
     rs = np.array(rs) * 200 / 50.
     
-    circle = lambda ri : r < ri
-    
-    for z in range(duck3d.shape[0]):
-        duck3d[z, :, :] = circle(rs[z]) * duck
-
-    # now interpolate the duck onto the required grid
-    duck3d = interp_3d(duck3d, shape)
-
-    # get rid of the crap
-    duck3d[np.where(duck3d < 0.1)] = 0.0
+    duck3d = (r[np.newaxis, :, :] < rs[z][:, np.newaxis, np.newaxis]) * duck[np.ix_(i, j)]
     return duck3d
         
 if __name__ == '__main__':
@@ -0,0 +1,239 @@
+"""
+Time the main stages of the simulation and phasing and write the
+results to a json file, so that commits can be compared:
+
+    Mapper_naive and Mapper_ellipse : __init__, Pmod, Psup, Emod
+    P212121                         : solid_syms_Fourier, unflip_modes_Fourier
+    lattice                         : (not memoized)
+    choose_N_highest_pixels         : cold, and warm started (N_highest_pixels)
+    add_noise_3d, generate_diff     : (double precision only)
+
+for each detector shape and dtype. The unit cell is half the detector
+shape and the voxel number is 1/400 of the detector volume.
+generate_diff includes making the duck, which is slow, use -b to 
+run only some of the benchmarks.
+
+usage:
+    python bench.py [-s 64 128 256] [-d single double] [-r 5] [-b mappers ...] [-o bench.json]
+    python bench.py -c old.json new.json [-t 0.2]
+
+The second form prints the ratio of the (minimum) times in new.json
+to those in old.json and exits with status 1 if any stage is more than
+a fraction t slower.
+
+Each record in the json file is:
+    {'name' : 'Mapper_naive.Pmod', 'shape' : [64, 64, 64], 'dtype' : 'double',
+     'times' : [...], 'min' : ..., 'median' : ..., 'mean' : ..., 'rss' : ...}
+(times in seconds, rss is the resident memory in bytes after the stage).
+"""
+from __future__ import print_function
+from __future__ import division
+
+import numpy as np
+import argparse
+import datetime
+import platform
+import json
+
+# test the package that this script is in
+import os, sys
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(root))
+
+import crappy_crystals
+from crappy_crystals.phasing import maps
+from crappy_crystals.phasing import symmetry_operations
+from crappy_crystals.utils import add_noise_3d
+from crappy_crystals.utils import profiling
+from crappy_crystals.utils.forward_sim import generate_diff
+
+dtypes = {'single' : np.float32, 'double' : np.float64}
+
+def record(name, shape, dtype, times):
+    r = {'name'   : name,
+         'shape'  : [int(n) for n in shape],
+         'dtype'  : dtype,
+         'times'  : times,
+         'rss'    : profiling.rss()}
+    r.update(profiling.stats(times))
+    return r
+
+def mapper_args(shape, dtype):
+    unit_cell = tuple([n//2 for n in shape])
+    return {'disorder'     : {'n' : 10, 'sigma' : 1.},
+            'detector'     : {'shape' : shape},
+            'crystal'      : {'unit_cell' : unit_cell, 'space_group' : 'P212121'},
+            'voxel_number' : int(np.prod(shape)) // 400,
+            'dtype'        : dtype,
+            'O'            : np.random.random(shape),
+            'mask'         : np.random.random(shape) > 0.1}
+
+def bench_mappers(shape, dtype, repeats):
+    out = []
+    I   = 100. * np.random.random(shape)
+    for Mapper in [maps.Mapper_naive, maps.Mapper_ellipse]:
+        args = mapper_args(shape, dtype)
+        name = Mapper.__name__
+
+        out.append(record(name + '.__init__', shape, dtype, profiling.timed(lambda : Mapper(I, **args), repeats)))
+
+        m = Mapper(I, **args)
+        for stage in ['Pmod', 'Psup', 'Emod']:
+            out.append(record(name + '.' + stage, shape, dtype, profiling.timed(uncached(m, stage), repeats)))
+    return out
+
+def uncached(m, stage):
+    """
+    call m.stage(m.modes) without the Imap/eMod of the previous call
+    (see Mapper_naive.Imap_eMod), otherwise Pmod and Emod would reuse them
+    """
+    f = getattr(m, stage)
+    def g():
+        if hasattr(m, 'Imap_modes'):
+            m.Imap_modes = None
+        return f(m.modes)
+    return g
+
+def bench_symmetry(shape, dtype, repeats):
+    c_dtype   = np.result_type(dtypes[dtype], np.complex64)
+    unit_cell = tuple([n//2 for n in shape])
+    sym_ops   = symmetry_operations.P212121(unit_cell, shape, dtype = c_dtype)
+
+    solid = (np.random.random(shape) + 1J * np.random.random(shape)).astype(c_dtype)
+    U     = np.empty((4,) + shape, dtype = c_dtype)
+    out   = np.empty_like(U)
+    return [record('P212121.solid_syms_Fourier', shape, dtype,
+                   profiling.timed(lambda : sym_ops.solid_syms_Fourier(solid, out = U), repeats)),
+            record('P212121.unflip_modes_Fourier', shape, dtype,
+                   profiling.timed(lambda : sym_ops.unflip_modes_Fourier(U, out = out), repeats))]
+
+def bench_lattice(shape, dtype, repeats):
+    unit_cell = tuple([n//2 for n in shape])
+    def f():
+        symmetry_operations._lattices.clear()
+        symmetry_operations.lattice(unit_cell, shape)
+    return [record('lattice', shape, dtype, profiling.timed(f, repeats))]
+
+def bench_n_highest_pixels(shape, dtype, repeats):
+    N     = int(np.prod(shape)) // 400
+    array = np.random.random(shape).astype(dtypes[dtype])
+
+    # warm start: the array changes a little between calls (as it does between iterations)
+    n_highest_pixels = maps.N_highest_pixels(shape)
+    arrays = [array * (1. + 1.0e-3 * np.random.random(shape)).astype(array.dtype) for i in range(2)]
+    calls  = [0]
+    def warm():
+        calls[0] += 1
+        n_highest_pixels(arrays[calls[0] % 2], N)
+
+    return [record('choose_N_highest_pixels', shape, dtype,
+                   profiling.timed(lambda : maps.choose_N_highest_pixels(array, N), repeats)),
+            record('N_highest_pixels (warm)', shape, dtype, profiling.timed(warm, repeats))]
+
+def bench_add_noise_3d(shape, dtype, repeats):
+    unit_cell = tuple([n//2 for n in shape])
+    diff      = 100. * np.random.random(shape)
+    return [record('add_noise_3d', shape, dtype,
+                   profiling.timed(lambda : add_noise_3d.add_noise_3d(diff, 1000, unit_cell_size = unit_cell), repeats))]
+
+def bench_generate_diff(shape, dtype, repeats):
+    unit_cell = tuple([n//2 for n in shape])
+    config = {'simulation' : {'shape' : (24, 28, 30), 'unit_cell' : unit_cell, 'space_group' : 'P212121',
+                              'n' : 10, 'sigma' : 1., 'photons' : 1000, 'cut_courners' : False,
+                              'beamstop' : None, 'support_frac' : None, 'background' : None},
+              'detector'   : {'shape' : shape}}
+    return [record('generate_diff', shape, dtype, profiling.timed(lambda : generate_diff(config), repeats))]
+
+# name, function, depends on the dtype
+benches = [('mappers',          bench_mappers,          True),
+           ('symmetry',         bench_symmetry,         True),
+           ('lattice',          bench_lattice,          False),
+           ('n_highest_pixels', bench_n_highest_pixels, True),
+           ('add_noise_3d',     bench_add_noise_3d,     False),
+           ('generate_diff',    bench_generate_diff,    False)]
+
+def git_commit():
+    import subprocess
+    try :
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = root).decode().strip()
+    except Exception :
+        return None
+
+def run(shapes, dts, repeats, only = None):
+    out = {'commit'   : git_commit(),
+           'date'     : datetime.datetime.now().isoformat(),
+           'python'   : platform.python_version(),
+           'numpy'    : np.__version__,
+           'machine'  : platform.platform(),
+           'repeats'  : repeats,
+           'results'  : []}
+
+    for N in shapes:
+        shape = (N, N, N)
+        for name, f, per_dtype in benches:
+            if only is not None and name not in only :
+                continue
+
+            for dtype in (dts if per_dtype else ['double']):
+                np.random.seed(1)
+                for r in f(shape, dtype, repeats):
+                    print('%-32s %-16s %-7s min: %9.4f s  mean: %9.4f s' % \
+                          (r['name'], 'x'.join([str(n) for n in r['shape']]), r['dtype'], r['min'], r['mean']))
+                    sys.stdout.flush()
+                    out['results'].append(r)
+
+    out['peak_rss'] = profiling.peak_rss()
+    return out
+
+def key(r):
+    return (r['name'], tuple(r['shape']), r['dtype'])
+
+def compare(old, new, tolerance = 0.2):
+    """
+    Print the ratio of the minimum times in new to those in old,
+    return the records that are slower by more than the fraction tolerance.
+    """
+    old_r = dict([(key(r), r) for r in old['results']])
+    slower = []
+    print('old commit:', old.get('commit'), '\nnew commit:', new.get('commit'))
+    print('%-32s %-16s %-7s %10s %10s %8s' % ('stage', 'shape', 'dtype', 'old (s)', 'new (s)', 'new/old'))
+    for r in new['results']:
+        if key(r) not in old_r :
+            continue
+        o = old_r[key(r)]
+        ratio = r['min'] / o['min'] if o['min'] > 0 else np.inf
+        flag  = ''
+        if ratio > 1. + tolerance :
+            flag = 'slower'
+            slower.append(r)
+        print('%-32s %-16s %-7s %10.4f %10.4f %8.2f %s' % \
+              (r['name'], 'x'.join([str(n) for n in r['shape']]), r['dtype'], o['min'], r['min'], ratio, flag))
+    return slower
+
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser(description='time the simulation and phasing stages')
+    parser.add_argument('-s', '--shapes', type=int, nargs='+', default=[64, 128, 256],
+                        help='the detector shapes (N for N x N x N)')
+    parser.add_argument('-d', '--dtypes', nargs='+', default=['single', 'double'], choices=['single', 'double'])
+    parser.add_argument('-r', '--repeats', type=int, default=5, help='timed calls of each stage')
+    parser.add_argument('-b', '--benches', nargs='+', default=None, choices=[b[0] for b in benches],
+                        help='only run these benchmarks')
+    parser.add_argument('-o', '--output', default='bench.json', help='the json file to write')
+    parser.add_argument('-c', '--compare', nargs=2, default=None, metavar=('OLD', 'NEW'),
+                        help='compare two json files instead of running the benchmarks')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2,
+                        help='flag stages that are slower than this fraction when comparing')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_cmdline_args()
+
+    if args.compare is not None :
+        old, new = [json.load(open(fnam)) for fnam in args.compare]
+        slower   = compare(old, new, args.tolerance)
+        sys.exit(1 if len(slower) > 0 else 0)
+
+    out = run(args.shapes, args.dtypes, args.repeats, args.benches)
+    with open(args.output, 'w') as f:
+        json.dump(out, f, indent = 2, sort_keys = True)
+    print('\nwrote', args.output)
@@ -0,0 +1,121 @@
+"""
+Time the P212121 symmetry operations (median of 10 calls, see
+utils/profiling.timed) and check that they do not allocate any
+volume sized arrays when an output array is supplied.
+
+The allocations are measured as the growth of the peak resident memory
+of the process (VmHWM in /proc/self/status) during a call, after the
+peak has been reset to the current resident memory (/proc/self/clear_refs,
+linux). glibc is told to mmap every allocation above 1 MB (mallopt) so
+that a volume sized temporary always shows up as new resident memory
+rather than reusing freed heap memory.
+
+With an output array solid_syms_Fourier and unflip_modes_Fourier must
+write into it and allocate less than 'tol' volumes per call (only a few
+small python objects and the fixed size buffer that numpy uses when it
+broadcasts the translation factors), solid_syms_Fourier without one
+writes into sym_ops.syms. Exits with status 1 if a check fails.
+
+usage: python bench_symmetry.py [N]
+    for an N x N x N detector (default 128)
+"""
+from __future__ import print_function
+
+import numpy as np
+
+# test the package that this script is in
+import os, sys
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(root))
+
+from crappy_crystals.phasing import symmetry_operations
+from crappy_crystals.utils import profiling
+
+# allowed allocation per call (in volumes)
+tol = 0.05
+
+def mmap_large_allocations(threshold = 2**20):
+    """
+    mmap (and so return to the os on free) every allocation above
+    threshold bytes, returns False if this is not glibc.
+    """
+    try :
+        import ctypes
+        M_MMAP_THRESHOLD = -3
+        return ctypes.CDLL('libc.so.6').mallopt(M_MMAP_THRESHOLD, threshold) == 1
+    except (OSError, AttributeError):
+        return False
+
+def peak_resident():
+    """the peak resident memory of this process in bytes (VmHWM)"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM'):
+                return int(line.split()[1]) * 1024
+
+def allocated(f, calls = 3):
+    """
+    return the largest growth (in bytes) of the peak resident memory
+    during a call of f, or None if it cannot be measured.
+    """
+    out = 0
+    for i in range(calls):
+        try :
+            with open('/proc/self/clear_refs', 'w') as g:
+                g.write('5')
+            p0 = peak_resident()
+        except (IOError, OSError, TypeError):
+            return None
+        f()
+        out = max(out, peak_resident() - p0)
+    return out
+
+def bench(shape, rfft = False):
+    """
+    time and check the symmetry operations, returns False if a check fails
+    """
+    unit_cell = tuple([n//2 for n in shape])
+    sym_ops   = symmetry_operations.P212121(unit_cell, shape, rfft = rfft)
+
+    fshape = symmetry_operations.Fourier_shape(shape, rfft)
+    solid  = np.random.random(fshape) + 1J * np.random.random(fshape)
+    U      = np.empty((4,) + fshape, dtype=solid.dtype)
+    out    = np.empty_like(U)
+    volume = solid.nbytes
+
+    # warm up (makes the translations and sym_ops.syms)
+    sym_ops.solid_syms_Fourier(solid)
+    sym_ops.solid_syms_Fourier(solid, out = U)
+    sym_ops.unflip_modes_Fourier(U, out = out)
+
+    ok = True
+    print('\nshape:', shape, 'rfft:', rfft, 'one volume: %.1f MB' % (volume / 1.0e6))
+    # name, function, output buffer (None if the function allocates it)
+    for name, f, buf in [('solid_syms_Fourier (out)     ', lambda : sym_ops.solid_syms_Fourier(solid, out = U), U),
+                         ('solid_syms_Fourier (internal)', lambda : sym_ops.solid_syms_Fourier(solid), sym_ops.syms),
+                         ('unflip_modes_Fourier (out)   ', lambda : sym_ops.unflip_modes_Fourier(U, out = out), out),
+                         ('unflip_modes_Fourier         ', lambda : sym_ops.unflip_modes_Fourier(U), None)]:
+        t = profiling.stats(profiling.timed(f, 10))['median']
+        a = allocated(f)
+        if a is None :
+            print(name, ': %.4f s' % t, '(allocations: /proc/self/clear_refs not available)')
+            continue
+
+        line = name + ' : %.4f s allocated: %.3f volumes' % (t, a / float(volume))
+        if buf is not None :
+            passed = np.shares_memory(f(), buf) and a < tol * volume
+            ok     = ok and passed
+            line  += ' (output in place and < %.2f volumes ? %s)' % (tol, passed)
+        print(line)
+    return ok
+
+if __name__ == '__main__':
+    N = 128
+    if len(sys.argv) > 1 :
+        N = int(sys.argv[1])
+
+    if not mmap_large_allocations():
+        print('could not set the mmap threshold (not glibc?), small temporaries may be missed')
+
+    ok = all([bench((N, N, N), rfft) for rfft in [False, True]])
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,90 @@
+"""
+Check the Cheshire cell scan of Mapper_ellipse (see maps.cheshire_errors)
+against the modulus error of the shifted solid unit, evaluated directly
+with Mapper_ellipse.Emod.
+
+usage: python cheshire.py
+"""
+from __future__ import print_function
+
+import numpy as np
+import multiprocessing
+
+# test the package that this script is in
+import os, sys
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(root))
+
+from crappy_crystals.phasing import maps
+from crappy_crystals.phasing import symmetry_operations
+
+shape     = (32, 32, 30)
+unit_cell = (16, 16, 14)
+cheshire  = (8, 8, 7)
+
+def make_mapper(mask = None, real_object = False):
+    args = {'disorder'     : {'n' : 10, 'sigma' : 1.},
+            'detector'     : {'shape' : shape},
+            'crystal'      : {'unit_cell' : unit_cell, 'space_group' : 'P212121'},
+            'voxel_number' : 150,
+            'mask'         : mask,
+            'real_object'  : real_object}
+
+    O = np.zeros(shape)
+    O[:6, :7, :5] = np.random.random((6, 7, 5))
+    m = maps.Mapper_naive(np.ones(shape), O = O, **args)
+    I = np.random.poisson(10. * m.Imap(m.modes)) / 10.
+    if real_object :
+        I = m.half.full(I).real
+    return maps.Mapper_ellipse(I, **args)
+
+def shifted_modes(mapper, s, t):
+    """the (diffuse and unit cell) modes of the solid unit s shifted by t"""
+    s = symmetry_operations.multiroll(s, t)
+    s = np.fft.rfftn(s) if mapper.rfft else np.fft.fftn(s)
+    modes = np.empty_like(mapper.modes)
+    M     = modes.shape[0] // 2
+    mapper.sym_ops.solid_syms_Fourier(s, apply_translation = False, out = modes[:M])
+    mapper.sym_ops.solid_syms_Fourier(s, apply_translation = True,  out = modes[M:])
+    return modes
+
+def test_errors(mask = None, real_object = False):
+    """
+    cheshire_errors == Emod of the shifted solid unit, at a few shifts
+    """
+    np.random.seed(1)
+    if mask is not None :
+        mask = np.random.random(shape) > mask
+    mapper = make_mapper(mask, real_object)
+
+    s = np.zeros(shape)
+    s[:6, :7, :5] = np.random.random((6, 7, 5))
+    errors = maps.cheshire_errors(mapper, shifted_modes(mapper, s, (0, 0, 0)), cheshire, processes = 1)
+
+    d = max([abs(mapper.Emod(shifted_modes(mapper, s, t)) - errors[t]) \
+             for t in [(0, 0, 0), (3, 5, 2), (7, 1, 6), (1, 7, 0)]])
+    print('mask:', mask is not None, 'real_object:', real_object, 'cheshire_errors == Emod ?', d < 1.0e-8)
+
+def _scan(i):
+    np.random.seed(i)
+    mapper = make_mapper()
+    s, info = mapper.scans_cheshire(np.random.random(shape))
+    return info['errors'].shape
+
+def test_daemon():
+    """
+    scans_cheshire runs (serially) in the workers of a pool,
+    as it does in the phasing repeats
+    """
+    pool = multiprocessing.Pool(2)
+    out  = pool.map(_scan, range(2))
+    pool.close()
+    pool.join()
+    print('scans_cheshire in a pool worker ?', out == [cheshire, cheshire])
+
+if __name__ == '__main__':
+    for real_object in [False, True]:
+        test_errors(None, real_object)
+        test_errors(0.1, real_object)
+
+    test_daemon()
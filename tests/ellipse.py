@@ -1,9 +1,35 @@
 import numpy as np
 
+# test the kernel that the mappers use 
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'phasing')))
+
 import pyximport; pyximport.install()
-from ellipse_2D_cython import project_2D_Ellipse_cython
+from ellipse_2D_cython import project_2D_Ellipse_cython, project_2D_Ellipse_arrays_cython
 #import ellipse_2D_cython
 #import project_2D_Ellipse_cython
+
+def test_arrays(N = 10000):
+    """
+    check that the array version of the projection agrees with the 
+    scalar version element by element (including the e0_inf / e1_inf
+    and zero axis special cases).
+    """
+    e0 = 3. * np.random.random(N)
+    e1 = 3. * np.random.random(N)
+    e0[: N//100]         = 0.
+    e1[N//200 : N//50]   = 0.
+    x  = 2. * np.random.standard_normal(N)
+    y  = 2. * np.random.standard_normal(N)
+    e0_inf = np.random.random(N) < 0.05
+    e1_inf = np.random.random(N) < 0.05
+    
+    u = np.empty_like(x)
+    v = np.empty_like(x)
+    project_2D_Ellipse_arrays_cython(e0, e1, x, y, e0_inf.view(np.uint8), e1_inf.view(np.uint8), u, v)
+
+    uv = np.array([project_2D_Ellipse_cython(*a) for a in zip(e0, e1, x, y, e0_inf, e1_inf)])
+    print('arrays == scalar ?', np.allclose(uv[:, 0], u) and np.allclose(uv[:, 1], v))
     
 if __name__ == '__main__':
     e0 = 2.0
@@ -12,3 +38,5 @@ if __name__ == '__main__':
     y = 1.5
     u, v = project_2D_Ellipse_cython(e0, e1, x, y)
     print(u, v)
+
+    test_arrays()
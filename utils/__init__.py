@@ -5,4 +5,7 @@ import io_utils
 import padding
 import l2norm
 import gaus
+import fft_backend
+import geometry
+import profiling
 from forward_sim import generate_diff 
@@ -1,4 +1,5 @@
 import numpy as np
+from geometry import get_geometry
 
 def add_noise_3d(diff, n, is_fft_shifted = True, remove_courners = True, unit_cell_size=None):
     """
@@ -33,19 +34,15 @@ def add_noise_3d(diff, n, is_fft_shifted = True, remove_courners = True, unit_ce
     
     mask = np.ones_like(diff, dtype = np.bool)
     
-    i = np.fft.fftfreq(diff.shape[0]) * diff.shape[0]
-    j = np.fft.fftfreq(diff.shape[1]) * diff.shape[1]
-    k = np.fft.fftfreq(diff.shape[2]) * diff.shape[2]
-    i, j, k = np.meshgrid(i, j, k, indexing='ij')
-    R      = np.sqrt(i**2 + j**2 + k**2)
-    R[0, 0, 0] = 0.5
+    R      = get_geometry(diff.shape).radius
     
-    # R scaling
-    R_scale   = 3. * ((R+1.)**2 - R**2) / ((R+1.)**3 - R**3)
-    diff_out  = diff_out * R_scale
+    # R scaling (R = 1/2 at the origin)
+    R_scale   = r_scale(R)
+    R_scale[0, 0, 0] = r_scale(np.array(0.5))
+    diff_out *= R_scale
 
     # normalise
-    diff_out = diff_out / np.sum(diff_out)
+    diff_out /= np.sum(diff_out)
 
     # calculate the total number of photons
     # from the mean number of photons per speckle
@@ -62,29 +59,41 @@ def add_noise_3d(diff, n, is_fft_shifted = True, remove_courners = True, unit_ce
     print 'oversampling :', over_sampling
 
     # Poisson sampling
-    diff_out = np.random.poisson(lam = N * diff_out).astype(np.float64)
+    diff_out *= N
+    diff_out[...] = np.random.poisson(lam = diff_out)
 
     # un-scale
     #R_scale  /= np.mean(R_scale) 
     diff_out /= R_scale
 
     # renormalise
-    diff_out = diff_out * norm / np.sum(diff_out)
+    diff_out *= norm / np.sum(diff_out)
 
     if remove_courners :
-        l = np.where(R >= np.min(diff.shape) / 2.)
+        l = R >= np.min(diff.shape) / 2.
         diff_out[l] = 0.0
         mask[l]     = False
 
     return diff_out, mask
 
+def r_scale(R):
+    """
+    3 [(R+1)^2 - R^2] / [(R+1)^3 - R^3] = 3 (2R + 1) / (3R^2 + 3R + 1)
+    
+    with one temporary volume.
+    """
+    den  = 3. * R
+    den += 3.
+    den *= R
+    den += 1.
+    out  = 6. * R
+    out += 3.
+    out /= den
+    return out
+
 def rad_av(diff, rs = None, is_fft_shifted = True):
     if rs is None :
-        i = np.fft.fftfreq(diff.shape[0]) * diff.shape[0]
-        j = np.fft.fftfreq(diff.shape[1]) * diff.shape[1]
-        k = np.fft.fftfreq(diff.shape[2]) * diff.shape[2]
-        i, j, k = np.meshgrid(i, j, k, indexing='ij')
-        rs      = np.sqrt(i**2 + j**2 + k**2).astype(np.int16).ravel()
+        rs = get_geometry(diff.shape).shells.ravel()
         
         if is_fft_shifted is False :
             rs = np.fft.ifftshift(rs)
@@ -1,14 +1,14 @@
 import numpy as np
+from geometry import get_geometry
 
 def make_beamstop(shape, rad, is_fft_shifted = True):
-    i = np.fft.fftfreq(shape[0]) * shape[0]
-    j = np.fft.fftfreq(shape[1]) * shape[1]
-    k = np.fft.fftfreq(shape[2]) * shape[2]
-    i, j, k = np.meshgrid(i, j, k, indexing='ij')
-    rs      = np.rint(np.sqrt(i**2 + j**2 + k**2)).astype(np.int16)
+    # rint(r) >= rad  <-->  r >= ceil(rad) - 1/2 
+    # (r is never half way between two integers since r^2 is an integer)
+    rs = get_geometry(shape).radius
+    beamstop = rs >= np.ceil(rad) - 0.5
         
     if is_fft_shifted is False :
-        rs = np.fft.ifftshift(rs)
+        beamstop = np.fft.ifftshift(beamstop)
 
-    return rs >= rad
+    return beamstop
 
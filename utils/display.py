@@ -79,12 +79,9 @@ def make_crystal(fnam):
         print '\nsolid_unit = solid_unit'
         solid_unit = kwargs['solid_unit']
     
-    if config['crystal']['space_group'] == 'P1':
-        sym_ops = symmetry_operations 
-        sym_ops_obj = sym_ops.P1(config['crystal']['unit_cell'], config['detector']['shape'])
-    elif config['crystal']['space_group'] == 'P212121':
-        sym_ops = symmetry_operations
-        sym_ops_obj = sym_ops.P212121(config['crystal']['unit_cell'], config['detector']['shape'])
+    sym_ops = symmetry_operations
+    sym_ops_obj = sym_ops.Space_group(config['crystal']['space_group'], \
+                                      config['crystal']['unit_cell'], config['detector']['shape'])
     
     Solid_unit = np.fft.fftn(solid_unit, config['detector']['shape'])
     solid_unit_expanded = np.fft.ifftn(Solid_unit)
@@ -169,7 +166,8 @@ class Iso_surface():
 
 class Application():
 
-    def __init__(self, fnam, **kwargs):
+    def __init__(self, fnam, kwargs):
+        """kwargs is the output of read_input_output_h5(fnam)"""
         real_space_crystal = make_crystal(fnam)
         
         if 'solid_unit_retrieved' in kwargs.keys():
@@ -187,13 +185,14 @@ class Application():
         
         duck_plots = np.hstack(duck_plots)
         
+        # only read the slices that are shown
         if 'data_retrieved' in kwargs.keys():
-            diff = kwargs['data_retrieved']
+            key = 'data_retrieved'
         elif 'data' in kwargs.keys():
-            diff = kwargs['data']
-        diff_plots = np.hstack((np.fft.ifftshift(diff[0, :, :]), \
-                                np.fft.ifftshift(diff[:, 0, :]), \
-                                np.fft.ifftshift(diff[:, :, 0])))
+            key = 'data'
+        diff_plots = np.hstack((np.fft.ifftshift(kwargs.read(key, np.s_[0, :, :])), \
+                                np.fft.ifftshift(kwargs.read(key, np.s_[:, 0, :])), \
+                                np.fft.ifftshift(kwargs.read(key, np.s_[:, :, 0]))))
         diff_plots = diff_plots**0.2
         
         # Always start by initializing Qt (only once per application)
@@ -314,4 +313,4 @@ if __name__ == '__main__':
         
         signal.signal(signal.SIGINT, signal.SIG_DFL)    # allow Control-C
         #app = QtGui.QApplication(sys.argv)
-        ex  = Application(fnam = args.path, **kwargs)
+        ex  = Application(args.path, kwargs)
@@ -0,0 +1,237 @@
+"""
+Pluggable n-dimensional FFTs for the mappers and the forward simulation.
+
+The backend is chosen with the [phasing_parameters] entries of config.ini:
+
+    fft_backend = numpy, scipy or pyfftw
+    fft_threads = number of threads (None uses every core)
+    fft_wisdom  = file name in which pyfftw wisdom is kept (or None)
+
+Single precision input gives single precision output for every backend.
+
+FFT objects (and therefore their plans and aligned buffers) are cached
+per (backend, threads, wisdom) so that mappers created for every ERA / DM
+stage, and the simulation, all share the same plans.
+
+    fft = get_fft(params)
+    A   = fft.fftn(a)
+    A   = fft.fftn(a, s = shape) # zero padded to shape
+    a   = fft.ifftn(A)
+    
+    # for real arrays (half of the last axis)
+    A   = fft.rfftn(a)
+    a   = fft.irfftn(A, a.shape)
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import numpy as np
+import multiprocessing
+import os
+
+backends = ['numpy', 'scipy', 'pyfftw']
+
+# FFT objects, one for each (backend, threads, wisdom)
+_ffts = {}
+
+def get_fft(params = None):
+    """
+    Return the (cached) FFT object selected by the 'fft_backend',
+    'fft_threads' and 'fft_wisdom' entries of the params dictionary.
+    If params is None or an entry is missing then the numpy backend
+    is used.
+    """
+    backend = 'numpy'
+    threads = None
+    wisdom  = None
+    if params is not None :
+        if params.get('fft_backend', None) not in [None, False] :
+            backend = params['fft_backend']
+
+        if params.get('fft_threads', None) not in [None, False] :
+            threads = int(params['fft_threads'])
+
+        if params.get('fft_wisdom', None) not in [None, False] :
+            wisdom = params['fft_wisdom']
+
+    key = (backend, threads, wisdom)
+    if key not in _ffts :
+        _ffts[key] = FFT(backend, threads, wisdom)
+    return _ffts[key]
+
+
+def pad(a, s, axes = None):
+    """
+    Zero pad (or crop) a to the shape s along axes (by default the last 
+    len(s) axes), keeping the start of each axis as np.fft.fftn does.
+    """
+    if axes is None :
+        axes = range(a.ndim - len(s), a.ndim)
+    
+    shape = list(a.shape)
+    for ax, n in zip(axes, s):
+        shape[ax] = n
+    if tuple(shape) == a.shape :
+        return a
+    
+    out = np.zeros(shape, dtype = a.dtype)
+    i   = tuple([slice(0, min(n, m)) for n, m in zip(a.shape, shape)])
+    out[i] = a[i]
+    return out
+
+
+class FFT():
+    """
+    n-dimensional forward and inverse FFTs with the numpy normalisation
+    convention (the inverse is divided by the number of elements).
+
+    numpy  : np.fft, single threaded.
+    scipy  : scipy.fft with 'workers' (scipy.fftpack if scipy.fft is missing).
+    pyfftw : one FFTW plan and pair of aligned buffers is made for each
+             (transform, shape, dtype, axes) and reused on every call,
+             the wisdom is loaded from / saved to 'wisdom' if given.
+    """
+    def __init__(self, backend = 'numpy', threads = None, wisdom = None):
+        if backend not in backends :
+            raise ValueError('unknown fft backend: ' + str(backend) + ' (choose from ' + str(backends) + ')')
+
+        if threads is None :
+            threads = multiprocessing.cpu_count()
+
+        self.backend = backend
+        self.threads = threads
+        self.wisdom  = wisdom
+        self.plans   = {}
+
+        if backend == 'scipy' :
+            try :
+                import scipy.fft
+                w = self.threads
+                self._funcs = {'fftn'   : lambda a, s, axes : scipy.fft.fftn(a, s, axes, workers = w), 
+                               'ifftn'  : lambda a, s, axes : scipy.fft.ifftn(a, s, axes, workers = w),
+                               'rfftn'  : lambda a, s, axes : scipy.fft.rfftn(a, s, axes, workers = w), 
+                               'irfftn' : lambda a, s, axes : scipy.fft.irfftn(a, s, axes, workers = w)}
+            except ImportError :
+                import scipy.fftpack
+                print('scipy.fft not found, falling back to (single threaded) scipy.fftpack')
+                self._funcs = {'fftn'   : scipy.fftpack.fftn, 
+                               'ifftn'  : scipy.fftpack.ifftn,
+                               'rfftn'  : np.fft.rfftn,
+                               'irfftn' : np.fft.irfftn}
+
+        elif backend == 'pyfftw' :
+            import pyfftw
+            self.pyfftw = pyfftw
+            if self.wisdom is not None and os.path.exists(self.wisdom):
+                import pickle
+                print('loading fftw wisdom:', self.wisdom)
+                pyfftw.import_wisdom(pickle.load(open(self.wisdom, 'rb')))
+
+        else :
+            self._funcs = {'fftn'   : np.fft.fftn, 
+                           'ifftn'  : np.fft.ifftn,
+                           'rfftn'  : np.fft.rfftn,
+                           'irfftn' : np.fft.irfftn}
+
+    def fftn(self, a, axes = None, out = None, s = None):
+        """
+        Forward FFT of a over axes (all by default). If out is given the
+        result is written into it. If s is given then a is zero padded 
+        (or cropped) to the shape s along axes first, as in np.fft.fftn.
+        """
+        if s is not None :
+            if axes is None :
+                axes = range(a.ndim - len(s), a.ndim)
+            a = pad(a, s, axes)
+        return self._transform('fftn', a, None, axes, out)
+
+    def ifftn(self, a, axes = None, out = None):
+        """
+        Inverse FFT of a over axes (all by default). If out is given the
+        result is written into it.
+        """
+        return self._transform('ifftn', a, None, axes, out)
+
+    def rfftn(self, a, axes = None, out = None):
+        """
+        Forward FFT of the real array a over axes (all by default), only 
+        the non-negative frequencies of the last axis are returned. If 
+        out is given the result is written into it.
+        """
+        return self._transform('rfftn', a.real, None, axes, out)
+
+    def irfftn(self, a, s, axes = None, out = None):
+        """
+        Inverse of rfftn, s is the shape of the (real) output along axes. 
+        If out is given the result is written into it.
+        """
+        return self._transform('irfftn', a, tuple(s), axes, out)
+
+    def _transform(self, kind, a, s, axes, out):
+        if self.backend == 'pyfftw' :
+            plan = self._plan(kind, a, s, axes)
+            plan.input_array[...] = a
+            plan()
+            b = plan.output_array
+            if out is None :
+                return b.copy()
+        else :
+            b = self._funcs[kind](a, s, axes)
+            
+            # keep single precision (np.fft always returns double precision)
+            if a.dtype in [np.float32, np.complex64] and b.dtype in [np.float64, np.complex128] :
+                if np.iscomplexobj(b) :
+                    b = b.astype(np.complex64)
+                else :
+                    b = b.astype(np.float32)
+
+        if out is None :
+            return b
+
+        out[...] = b
+        return out
+
+    def _plan(self, kind, a, s, axes):
+        if axes is None :
+            axes = tuple(range(a.ndim))
+        else :
+            axes = tuple(axes)
+
+        if a.dtype in [np.float32, np.complex64] :
+            r_dtype, c_dtype = np.float32, np.complex64
+        else :
+            r_dtype, c_dtype = np.float64, np.complex128
+
+        key = (kind, a.shape, s, np.dtype(c_dtype).str, axes)
+        if key not in self.plans :
+            if kind in ['fftn', 'rfftn'] :
+                direction = 'FFTW_FORWARD'
+            else :
+                direction = 'FFTW_BACKWARD'
+            
+            # the shape and type of the input and output buffers
+            shape_in, dtype_in, shape_out, dtype_out = a.shape, c_dtype, a.shape, c_dtype
+            if kind == 'rfftn' :
+                dtype_in  = r_dtype
+                shape_out = list(a.shape)
+                shape_out[axes[-1]] = a.shape[axes[-1]]//2 + 1
+            elif kind == 'irfftn' :
+                dtype_out = r_dtype
+                shape_out = list(a.shape)
+                for ax, n in zip(axes, s):
+                    shape_out[ax] = n
+
+            print('making fftw plan:', kind, shape_in, '-->', tuple(shape_out), np.dtype(c_dtype).name, 'threads:', self.threads)
+            b_in  = self.pyfftw.empty_aligned(shape_in, dtype = dtype_in)
+            b_out = self.pyfftw.empty_aligned(shape_out, dtype = dtype_out)
+            self.plans[key] = self.pyfftw.FFTW(b_in, b_out, axes = axes, direction = direction, \
+                                               flags = ('FFTW_MEASURE',), threads = self.threads)
+            self.save_wisdom()
+        return self.plans[key]
+
+    def save_wisdom(self):
+        if self.backend == 'pyfftw' and self.wisdom is not None :
+            import pickle
+            pickle.dump(self.pyfftw.export_wisdom(), open(self.wisdom, 'wb'))
@@ -2,20 +2,25 @@ import numpy as np
 import crappy_crystals.solid_units 
 import crappy_crystals.phasing.symmetry_operations as symmetry_operations 
 from crappy_crystals.utils import disorder
+from crappy_crystals.utils import geometry
+from crappy_crystals.utils import padding
 from crappy_crystals.utils import add_noise_3d
+from crappy_crystals.utils.fft_backend import get_fft
 
 
 def generate_diff(config):
-    solid_unit = crappy_crystals.solid_units.duck_3D.make_3D_duck(shape = config['simulation']['shape'])
+    cache_dir  = config.get('phasing_parameters', {}).get('cache_dir', None)
+    solid_unit = crappy_crystals.solid_units.duck_3D.make_3D_duck(shape = config['simulation']['shape'], cache_dir = cache_dir)
     #solid_unit *= np.random.random(solid_unit.shape)
     
-    if config['simulation']['space_group'] == 'P1':
-        sym_ops = symmetry_operations.P1(config['simulation']['unit_cell'], config['detector']['shape'])
-    elif config['simulation']['space_group'] == 'P212121':
-        sym_ops = symmetry_operations.P212121(config['simulation']['unit_cell'], config['detector']['shape'])
+    sym_ops = symmetry_operations.Space_group(config['simulation']['space_group'], \
+                                              config['simulation']['unit_cell'], config['detector']['shape'])
     
-    Solid_unit = np.fft.fftn(solid_unit, config['detector']['shape'])
-    solid_unit_expanded = np.fft.ifftn(Solid_unit)
+    # use the phasing fft routines if they are specified 
+    fft = get_fft(config.get('phasing_parameters', None))
+    
+    Solid_unit = fft.fftn(solid_unit, s = config['detector']['shape'])
+    solid_unit_expanded = fft.ifftn(Solid_unit)
 
     # define the solid_unit support
     if config['simulation']['support_frac'] is not None :
@@ -25,14 +30,15 @@ def generate_diff(config):
     
     #solid_unit_expanded = np.random.random(support.shape)*support + 0J
     solid_unit_expanded = solid_unit_expanded * support 
-    Solid_unit = np.fft.fftn(solid_unit_expanded)
+    Solid_unit = fft.fftn(solid_unit_expanded)
 
     modes = sym_ops.solid_syms_Fourier(Solid_unit)
     
     N   = config['simulation']['n']
-    exp = disorder.make_exp(config['simulation']['sigma'], config['detector']['shape'])
-    
-    lattice = symmetry_operations.lattice(config['simulation']['unit_cell'], config['detector']['shape'])
+    # the disorder weighting and lattice are shared with the phasing (see geometry.Geometry)
+    geom      = geometry.get_geometry(config['detector']['shape'], cache_dir)
+    exp       = geom.exp(config['simulation']['sigma'])
+    lattice   = geom.lattice(config['simulation']['unit_cell'])
     
     diff  = N * exp * lattice * np.abs(np.sum(modes, axis=0)**2)
     diff += (1. - exp) * np.sum(np.abs(modes)**2, axis=0)
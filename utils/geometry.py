@@ -0,0 +1,115 @@
+import numpy as np
+import os
+
+# the geometry of each detector shape, see get_geometry
+_geometries = {}
+
+def get_geometry(shape, cache_dir = None):
+    """
+    Return the (shared) Geometry of the detector shape, so that
+    the simulation and every mapper use the same arrays.
+
+    If cache_dir is not None then the arrays are also stored in /
+    loaded from .npz files in that directory.
+    """
+    key = tuple([int(n) for n in shape])
+    if key not in _geometries :
+        _geometries[key] = Geometry(key, cache_dir)
+
+    g = _geometries[key]
+    if cache_dir is not None :
+        g.cache_dir = cache_dir
+    return g
+
+
+class Geometry():
+    """
+    The reciprocal space geometry of the detector (np.fft.fftfreq basis,
+    fft shifted). Each array is made when it is first asked for and then
+    kept (read only):
+
+        radius             : |q| in pixel units
+        shells             : the integer part of radius (int16)
+        exp(sigma)         : the disorder weighting exp(-4 sigma^2 pi^2 |q|^2)
+        lattice(unit_cell) : the reciprocal lattice (see symmetry_operations.lattice)
+
+    They are made from 1D factors (see axes and exp_factors) by
+    broadcasting, so no coordinate volumes are made on the way.
+
+    If cache_dir is not None then radius, shells and exp are stored in / loaded from 'geometry_<shape>_<name>.npz' in cache_dir.
+    """
+    def __init__(self, shape, cache_dir = None):
+        self.shape     = tuple(shape)
+        self.cache_dir = cache_dir
+        self.arrays    = {}
+
+    def _get(self, name, make):
+        if name in self.arrays :
+            return self.arrays[name]
+
+        fnam = None
+        if self.cache_dir is not None :
+            fnam = os.path.join(self.cache_dir, 'geometry_' + 'x'.join([str(n) for n in self.shape]) + '_' + name + '.npz')
+
+        if fnam is not None and os.path.exists(fnam):
+            a = np.load(fnam)['a']
+        else :
+            a = make()
+            if fnam is not None :
+                np.savez(fnam, a = a)
+
+        a.setflags(write = False)
+        self.arrays[name] = a
+        return a
+
+    def axes(self, scale = False):
+        """
+        The q coordinates of each axis in fftfreq units or (if scale) in 
+        pixel units, shaped to broadcast against the detector volume.
+        """
+        out = []
+        for a, n in enumerate(self.shape):
+            s    = [1 for m in self.shape]
+            s[a] = n
+            out.append((np.fft.fftfreq(n) * (n if scale else 1.)).reshape(s))
+        return out
+
+    def _q2(self, scale = False):
+        # |q|^2 from the 1D squares: the only full volume is the output
+        i, j, k = [q**2 for q in self.axes(scale)]
+        out  = i + j
+        out  = out + k
+        return out
+
+    def _radius(self):
+        r = self._q2(True)
+        return np.sqrt(r, out = r)
+
+    @property
+    def radius(self):
+        return self._get('radius', self._radius)
+
+    @property
+    def shells(self):
+        return self._get('shells', lambda : self.radius.astype(np.int16))
+
+    def exp_factors(self, sigma):
+        """
+        The disorder weighting as a product of 1D Gaussians (that
+        broadcast against the detector volume):
+            exp(-4 sigma^2 pi^2 |q|^2) = prod_a exp(-4 sigma^2 pi^2 q_a^2)
+        """
+        return [np.exp(-4. * sigma**2 * np.pi**2 * q**2) for q in self.axes()]
+
+    def _exp(self, sigma):
+        i, j, k = self.exp_factors(sigma)
+        out = i * j
+        out = out * k
+        return out
+
+    def exp(self, sigma):
+        return self._get('exp_sigma' + repr(float(sigma)), lambda : self._exp(sigma))
+
+    def lattice(self, unit_cell):
+        import crappy_crystals.phasing.symmetry_operations as symmetry_operations
+        return symmetry_operations.lattice(unit_cell, self.shape, cache_dir = self.cache_dir)
@@ -1,4 +1,5 @@
 import numpy as np
+import collections
 
 def parse_cmdline_args():
     import argparse
@@ -21,6 +22,8 @@ def parse_cmdline_args_phasing():
     parser = argparse.ArgumentParser(prog = 'phase.py', description='phase a translationally disordered crystal')
     parser.add_argument('input', type=str, \
                         help="h5 file name of the input file")
+    parser.add_argument('--resume', action='store_true', \
+                        help="continue the phasing from the last checkpoint")
     args = parser.parse_args()
     return args
 
@@ -113,11 +116,17 @@ Names for things:
 """
 
 
-def write_input_output_h5(fnam, **kwargs):
+def write_input_output_h5(fnam, compression = 'gzip', float32 = False, **kwargs):
     """
     read a keyword list of things and write them
     (non recursive)
     
+    The volumes (3D or more) are written in chunks with the given
+    compression ('gzip', 'lzf' or None) so that they can be read 
+    in parts (see read_input_output_h5). Boolean arrays are stored 
+    as uint8 and if float32 is True then real floating point volumes 
+    (the intensities) are stored in single precision.
+    
     Names for things:
         measured intensity  = data
         retrieved intensity = data_retrieved
@@ -148,20 +157,44 @@ def write_input_output_h5(fnam, **kwargs):
                 h += line
             f.create_dataset('config_file', data = np.array(h))
             f.create_dataset('config_file_name', data = np.array(value))
-        elif value.dtype == bool :
-            print 'writing:', key, value.shape, value.dtype
-            f.create_dataset(key, data = value.astype(np.int16))
+            continue
+        
+        value = np.asarray(value)
+        is_bool = value.dtype == bool
+        if is_bool :
+            value = value.view(np.uint8)
+        elif float32 and value.dtype.kind == 'f' and value.ndim >= 3 :
+            value = value.astype(np.float32)
+        
+        print 'writing:', key, value.shape, value.dtype
+        if value.ndim >= 3 and compression is not None :
+            opts = 4 if compression == 'gzip' else None
+            f.create_dataset(key, data = value, chunks = True, shuffle = True, \
+                             compression = compression, compression_opts = opts)
         else :
-            print 'writing:', key, value.shape, value.dtype
             f.create_dataset(key, data = value)
+        
+        if is_bool :
+            f[key].attrs['bool'] = True
     
     f.close()
 
+def h5_options(params):
+    """
+    The write_input_output_h5 options (compression and float32) 
+    from the [output] section of the config file.
+    """
+    output = params.get('output', {})
+    return {'compression' : output.get('compression', 'gzip'), 
+            'float32'     : output.get('float32', False)}
+
 def read_input_output_h5(fnam):
     """
     read a keyword list of things from the input.h5 file 
     and return a dictionary (non recursive)
 
+    Nothing is read until it is asked for, see H5_lazy.
+
     Names for things:
         measured intensity  = data
         retrieved intensity = data_retrieved
@@ -175,41 +208,70 @@ def read_input_output_h5(fnam):
         config_file
         config_file_name 
     """
-    import h5py
-    
     print '\nreading input/output file:', fnam
-    f = h5py.File(fnam, 'r')
+    return H5_lazy(fnam)
+
+# written as int16 by older versions of write_input_output_h5
+bool_keys = ['sample_support', 'good_pix', 'good_pixels']
+
+class H5_lazy(collections.Mapping):
+    """
+    A read only dictionary of the datasets in the h5 file fnam.
+    
+    A dataset is read (and kept) the first time that it is asked
+    for, e.g. kwargs['data']. Part of a dataset can be read without 
+    reading (or keeping) the rest with kwargs.read(key, index), 
+    e.g. kwargs.read('data', np.s_[0, :, :]).
     
-    kwargs = {}
-    for key in f.keys():
+    The config_file is parsed (see parse_parameters) and boolean 
+    arrays are returned as np.bool.
+    """
+    def __init__(self, fnam):
+        import h5py
+        self.fnam   = fnam
+        self.loaded = {}
+        f = h5py.File(fnam, 'r')
+        self._keys  = list(f.keys())
+        f.close()
+    
+    def __getitem__(self, key):
+        if key not in self.loaded :
+            self.loaded[key] = self.read(key)
+        return self.loaded[key]
+    
+    def __iter__(self):
+        return iter(self._keys)
+    
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+    
+    def read(self, key, index = ()):
+        import h5py
+        if key not in self._keys :
+            raise KeyError(key)
+        
+        f = h5py.File(self.fnam, 'r')
+        d = f[key]
         if key == 'config_file':
-            config_file = f[key].value
-            
             print 'parsing the config_file...'
             # read then pass the config file
             import ConfigParser
             import StringIO
-            config_file = StringIO.StringIO(config_file)
+            config_file = StringIO.StringIO(d[()])
             
             config = ConfigParser.ConfigParser()
             config.readfp(config_file)
-            params = parse_parameters(config)
-            
-            kwargs[key] = params
+            value = parse_parameters(config)
         else :
             print 'reading:', key,
             
-            value = f[key].value
-            kwargs[key] = value
+            value = d[index]
+            if d.attrs.get('bool', False) or key in bool_keys :
+                value = np.asarray(value).astype(np.bool)
             
             print value.dtype, value.shape
-    f.close()
-    
-    if 'sample_support' in kwargs.keys():
-        kwargs['sample_support'] = kwargs['sample_support'].astype(np.bool)
-        print 'sample_support np.int16 --> np.bool'
-    
-    if 'good_pixels' in kwargs.keys():
-        kwargs['good_pixels'] = kwargs['good_pixels'].astype(np.bool)
-        print 'good_pixels np.int16 --> np.bool'
-    return kwargs
+        f.close()
+        return value
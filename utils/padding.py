@@ -1,20 +1,52 @@
 import numpy as np
 
 def expand_region_by(mask, frac):
+    """
+    Grow (or shrink) the region mask until it has frac * np.sum(mask) voxels.
+
+    The mask is blurred with a Gaussian (sigma = 1, or more if the blur
+    does not reach enough voxels) and the voxels with the highest blurred
+    values are kept. The threshold is found with a single np.partition,
+    so the region has the target number of voxels (plus any that tie
+    with the threshold).
+
+    The blur is zero beyond 4 sigma (scipy's truncate) of the mask, so
+    only the bounding box of the mask plus that margin is blurred.
+    """
     import scipy.ndimage
-    
-    N = np.sum(mask)
+
+    mask = np.asarray(mask, dtype=np.bool)
+    N    = np.sum(mask)
+    if N == 0 :
+        return mask.copy()
+
+    # at least one voxel more than frac * N
+    M = min(int(frac * N) + 1, mask.size)
+
+    # the bounding box of the mask
+    box = []
+    for axis in range(mask.ndim):
+        other = tuple([a for a in range(mask.ndim) if a != axis])
+        i     = np.flatnonzero(np.any(mask, axis = other))
+        box.append((i[0], i[-1] + 1))
+
     for sig in range(1, 20):
+        r    = int(4. * sig + 0.5)
+        crop = tuple([slice(max(b[0] - r, 0), min(b[1] + r, n)) for b, n in zip(box, mask.shape)])
+
         # convolve mask with a gaussian
-        mask_out = scipy.ndimage.filters.gaussian_filter(mask.copy().astype(np.float), sig, mode = 'constant')
-
-        # progressively truncate until the sesired number of pixels is reached
-        M = frac * N
-        threshs = np.linspace(mask_out.max(), mask_out.min(), 100)
-        for thresh in threshs:
-            s = np.sum(mask_out > thresh)
-            #print thresh, s
-            if s > M :
-                return (mask_out > thresh)
-
-        # we did not find a good candidate 
+        mask_out = scipy.ndimage.filters.gaussian_filter(mask[crop].astype(np.float), sig, mode = 'constant')
+
+        # the blur must reach at least M voxels
+        if np.count_nonzero(mask_out) >= M :
+            break
+    else :
+        return np.ones_like(mask)
+
+    # the M'th highest value
+    k      = mask_out.size - M
+    thresh = np.partition(mask_out.ravel(), k)[k]
+
+    out = np.zeros_like(mask)
+    out[crop] = mask_out >= thresh
+    return out
@@ -0,0 +1,284 @@
+"""
+Opt-in timing and memory instrumentation of the phasing stages.
+
+Set profile = True in the [phasing] section of config.ini, then every
+mapper made by the phasing algorithms is instrumented (see profiled) and
+the time and peak resident memory of each call of:
+
+    Mapper.__init__, Psup, Pmod, Imap, Emod,
+    sym_ops.solid_syms_Fourier, sym_ops.unflip_modes_Fourier,
+    n_highest_pixels (the voxel number support)
+    fft.fftn, fft.ifftn, fft.rfftn, fft.irfftn
+
+are recorded. Times are inclusive (e.g. Pmod includes the Imap it calls).
+The peak memory is sampled by a background thread (see Rss_sampler), so 
+the temporaries of a stage are included. Outer timers that wrap many of 
+these stages (e.g. a whole ERA stage) are opened with sample = False, so 
+the thread only polls while a leaf stage runs.
+
+    prof = Profile()
+    with prof.timer('my stage'):
+        ...
+    print(prof.summary())
+    write_h5('output.h5', [prof.to_dict()])
+
+timed and stats are the timing helpers of the benchmark scripts in tests/.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import numpy as np
+import contextlib
+import threading
+import time
+import os
+
+def peak_rss():
+    """The peak resident memory of this process in bytes (0 if unknown)."""
+    try :
+        import resource
+        # kB on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError :
+        return 0
+
+def rss():
+    """The current resident memory of this process in bytes."""
+    try :
+        import resource
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, ImportError):
+        return peak_rss()
+
+
+class Rss_sampler():
+    """
+    Keep the peak resident memory between start and stop. The memory is 
+    read every 'interval' seconds by a background thread (numpy, the 
+    ffts and the compiled kernels release the GIL while they work) and 
+    at start and stop. If the process reaches a new peak (peak_rss) 
+    during a watch then that peak is exact.
+    
+    A watch started with sample = False is not polled, it gets the peaks
+    of the watches that stop while it is open. The thread stops when no 
+    polled watch is open.
+    """
+    def __init__(self, interval = 1.0e-3):
+        self.interval = interval
+        self.watches  = []
+        self.running  = False
+        self.pid      = None
+
+    def start(self, sample = True):
+        """start a watch, returns the handle for stop"""
+        w = [rss(), peak_rss(), sample]
+        self.watches.append(w)
+        
+        # (re)start the thread, also in a forked worker process
+        if sample and (not self.running or self.pid != os.getpid()):
+            self.running = True
+            self.pid     = os.getpid()
+            t = threading.Thread(target = self._run)
+            t.daemon = True
+            t.start()
+        return w
+
+    def stop(self, w):
+        """the peak resident memory (bytes) since start"""
+        self.watches = [v for v in self.watches if v is not w]
+        m = max(w[0], rss())
+        p = peak_rss()
+        if p > w[1] :
+            m = max(m, p)
+        
+        # pass the peak on to the enclosing watches
+        for v in self.watches:
+            if m > v[0] :
+                v[0] = m
+        return m
+
+    def _run(self):
+        while True :
+            time.sleep(self.interval)
+            if not self.sampling() :
+                # check again in case start missed running = False
+                self.running = False
+                if not self.sampling() :
+                    return
+                self.running = True
+            
+            r = rss()
+            for w in self.watches:
+                if w[2] and r > w[0] :
+                    w[0] = r
+
+    def sampling(self):
+        """is a polled watch open"""
+        return any([w[2] for w in self.watches])
+
+# shared by every Profile of this process
+sampler = Rss_sampler()
+
+
+@contextlib.contextmanager
+def no_timer(name, sample = True):
+    """a stand in for Profile.timer when profiling is off"""
+    yield
+
+
+class Profile():
+    """
+    Keep the duration and the peak resident memory of every call
+    of each (named) stage.
+    """
+    def __init__(self):
+        self.times = {}
+        self.peak  = {}
+
+    @contextlib.contextmanager
+    def timer(self, name, sample = True):
+        """
+        Time the block as a call of name. Use sample = False for blocks
+        that enclose other timers, their peak memory is then the largest
+        of the enclosed peaks and the memory at the start and the end.
+        """
+        w  = sampler.start(sample)
+        t0 = time.time()
+        try :
+            yield
+        finally :
+            self.times.setdefault(name, []).append(time.time() - t0)
+            self.peak.setdefault(name, []).append(sampler.stop(w))
+
+    def timed(self, f, name):
+        """return f wrapped with timer(name)"""
+        def g(*args, **kwargs):
+            with self.timer(name):
+                return f(*args, **kwargs)
+        return g
+
+    def instrument(self, mapper):
+        """
+        Time the stages of the mapper instance (the methods are
+        replaced on this instance only).
+        """
+        for name in ['Psup', 'Pmod', 'Imap', 'Emod']:
+            if hasattr(mapper, name):
+                setattr(mapper, name, self.timed(getattr(mapper, name), name))
+
+        if hasattr(mapper, 'sym_ops'):
+            for name in ['solid_syms_Fourier', 'unflip_modes_Fourier']:
+                setattr(mapper.sym_ops, name, self.timed(getattr(mapper.sym_ops, name), name))
+
+        if getattr(mapper, 'n_highest_pixels', None) is not None :
+            mapper.n_highest_pixels = self.timed(mapper.n_highest_pixels, 'n_highest_pixels')
+
+        # the fft objects are shared between mappers, so time them through a proxy
+        if hasattr(mapper, 'fft'):
+            mapper.fft = Timed_proxy(mapper.fft, self, ['fftn', 'ifftn', 'rfftn', 'irfftn'], 'fft.')
+
+    def totals(self):
+        """
+        name --> (calls, total time (s), mean time (s), peak resident memory (bytes))
+        """
+        out = {}
+        for name, t in self.times.items():
+            out[name] = (len(t), np.sum(t), np.mean(t), np.max(self.peak[name]))
+        return out
+
+    def summary(self):
+        """a table of the totals (sorted by total time)"""
+        totals = self.totals()
+        lines  = ['%-22s %8s %12s %12s %14s' % ('stage', 'calls', 'total (s)', 'mean (ms)', 'peak rss (MB)')]
+        for name in sorted(totals, key = lambda n : -totals[n][1]):
+            calls, total, mean, m = totals[name]
+            lines.append('%-22s %8d %12.3f %12.3f %14.1f' % (name, calls, total, 1.0e3 * mean, m / 1.0e6))
+        lines.append('process peak rss (MB): %.1f' % (peak_rss() / 1.0e6))
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        """the traces as arrays (e.g. to return them from a worker process)"""
+        return {'times'    : dict([(k, np.array(v)) for k, v in self.times.items()]),
+                'peak'     : dict([(k, np.array(v)) for k, v in self.peak.items()]),
+                'peak_rss' : peak_rss()}
+
+
+def timed(f, repeats = 5):
+    """
+    Call f once (to warm up e.g. the fft plans) then repeats times.
+    Return the duration of each of the timed calls (s).
+    """
+    f()
+    times = []
+    for i in range(repeats):
+        t0 = time.time()
+        f()
+        times.append(time.time() - t0)
+    return times
+
+def stats(times):
+    """the min, median and mean of the durations in times (see timed)"""
+    return {'min'    : float(np.min(times)),
+            'median' : float(np.median(times)),
+            'mean'   : float(np.mean(times))}
+
+
+class Timed_proxy():
+    """
+    Delegate to obj, the methods in names are timed as prefix + name.
+    """
+    def __init__(self, obj, profile, names, prefix = ''):
+        self._obj = obj
+        for name in names:
+            if hasattr(obj, name):
+                setattr(self, name, profile.timed(getattr(obj, name), prefix + name))
+
+    def __getattr__(self, name):
+        return getattr(self._obj, name)
+
+
+def profiled(Mapper, profile):
+    """
+    Return a subclass of Mapper whose instances are instrumented
+    with profile (see Profile.instrument). The class is made at
+    run time so it cannot be pickled, make it in the process that
+    uses it.
+    """
+    class Profiled(Mapper):
+        def __init__(self, I, **args):
+            with profile.timer('Mapper.__init__'):
+                Mapper.__init__(self, I, **args)
+            profile.instrument(self)
+
+    Profiled.__name__ = Mapper.__name__
+    return Profiled
+
+def write_h5(fnam, profiles):
+    """
+    Add the profiles (a list of Profile.to_dict(), one for each repeat)
+    to the /profile group of the h5 file fnam:
+        /profile/repeat_<j>/<stage>/times    : the duration of each call (s)
+        /profile/repeat_<j>/<stage>/peak_rss : the peak resident memory of each call (bytes)
+
+    with the attributes calls and total for each stage and peak_rss
+    for each repeat.
+    """
+    import h5py
+    f = h5py.File(fnam, 'a')
+    if 'profile' in f :
+        del f['profile']
+
+    g = f.create_group('profile')
+    for j, p in enumerate(profiles):
+        r = g.create_group('repeat_' + str(j))
+        r.attrs['peak_rss'] = p['peak_rss']
+        for name in p['times']:
+            s = r.create_group(name)
+            s.create_dataset('times', data = p['times'][name])
+            s.create_dataset('peak_rss', data = p['peak'][name])
+            s.attrs['calls'] = len(p['times'][name])
+            s.attrs['total'] = np.sum(p['times'][name])
+    f.close()